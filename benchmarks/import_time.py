@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""
+Check that importing wanglib stays fast.
+
+Headless acquisition scripts import ``wanglib.instruments`` (and
+often ``wanglib.pylab_extensions``), so neither should pull in
+matplotlib until something is actually plotted. This script imports
+each module in a fresh interpreter, a few times, and fails if the
+fastest import is over budget or if pylab was loaded.
+
+    $ python benchmarks/import_time.py
+    $ python benchmarks/import_time.py --budget 0.2
+
+"""
+
+import sys
+import subprocess
+
+modules = ['wanglib.instruments', 'wanglib.pylab_extensions']
+
+# run in a fresh interpreter, so nothing is already imported
+probe = """
+import sys
+from time import time
+start = time()
+import %s
+elapsed = time() - start
+print elapsed, int('matplotlib' in sys.modules)
+"""
+
+def import_time(module, repeat=5):
+    """
+    Time the import of a module in a fresh interpreter.
+
+    Returns the fastest time (in seconds) of `repeat` tries, and
+    whether matplotlib got imported along the way.
+
+    """
+    times = []
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', probe % module])
+        elapsed, mpl = out.split()
+        times.append(float(elapsed))
+    return min(times), bool(int(mpl))
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("-b", "--budget", type="float", default=0.5,
+                      help="maximum import time, in seconds")
+    parser.add_option("-r", "--repeat", type="int", default=5,
+                      help="number of tries per module")
+    (options, args) = parser.parse_args()
+
+    failed = False
+    for module in args or modules:
+        elapsed, mpl = import_time(module, options.repeat)
+        status = 'ok'
+        if elapsed > options.budget:
+            status = 'SLOW'
+        if mpl:
+            status = 'IMPORTS MATPLOTLIB'
+        if status != 'ok':
+            failed = True
+        print "%-30s %6.3f s  %s" % (module, elapsed, status)
+    sys.exit(1 if failed else 0)
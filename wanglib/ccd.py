@@ -35,6 +35,11 @@ Client library
 To integrate the CCD client into your own script,
 use :class:`labview_client`.
 
+To average many frames without keeping them all in memory,
+use :class:`accumulator` (or :meth:`labview_client.get_average`).
+Frames hit by cosmic rays are rejected pixel-by-pixel as they
+come in.
+
 """
 
 import socket as s
@@ -139,6 +144,259 @@ class labview_client(object):
 
         #self.sock.close()
 
+    def get_average(self, frames, **kwargs):
+        """
+        Takes ``frames`` shots on the CCD and averages them,
+        rejecting cosmic rays along the way.
+
+        Returns a 2-tuple ``(wl, ccd)`` like :meth:`get_spectrum`,
+        but ``ccd`` is the per-pixel average of all the shots.
+        Only one frame is held in memory at a time.
+
+        Keyword arguments are passed to :class:`accumulator`.
+
+        >>> wl,ccd = clnt.get_average(100, nsigma=4)
+
+        """
+        acc = accumulator(**kwargs)
+        for i in range(frames):
+            wl,ccd = self.get_spectrum()
+            acc.add(ccd)
+        acc.finish()
+        return wl, acc.mean
+
+class accumulator(object):
+    """
+    Streaming average of a series of CCD frames, with
+    cosmic-ray rejection.
+
+    Rather than storing every frame and taking the median
+    afterwards, this keeps a running per-pixel mean and
+    variance (Welford's algorithm), so memory use does
+    not grow with the number of frames.
+
+    >>> acc = accumulator(nsigma=5)
+    >>> for i in range(500):
+    ...     wl,ccd = clnt.get_spectrum()
+    ...     acc.add(ccd)
+    >>> pylab.plot(wl, acc.mean.sum(axis=0))
+
+    A pixel which comes in more than ``nsigma`` standard deviations
+    *above* its running mean is flagged as a spike and left out of
+    the statistics. Cosmic rays only ever add counts, so low outliers
+    are kept. ``min_sigma`` is a floor on the standard deviation used
+    for this test, so that very quiet pixels (or a run of identical
+    frames) don't get every small fluctuation flagged.
+
+    The first ``warmup`` frames are held back until there are enough
+    of them to judge what a spike is. The statistics are then seeded
+    from them, using the per-pixel median and median absolute
+    deviation (which a spike hardly affects) to reject spikes among
+    the warmup frames too. Until then, :meth:`add` flags nothing
+    and the statistics below are None. Spikes found in the held-back
+    frames are counted in ``spikes``, but :meth:`add` only returns
+    the mask of the frame that ends the warmup. To seed from fewer
+    than ``warmup`` frames (a short run), call :meth:`finish`.
+
+    Statistics are available as attributes at any point after
+    the warmup (or :meth:`finish`):
+
+        :mean:      per-pixel average of the accepted values
+        :variance:  per-pixel sample variance of the accepted values
+        :std:       square root of ``variance``
+        :count:     number of values accepted at each pixel
+        :spikes:    number of values rejected at each pixel
+        :frames:    total number of frames added
+
+    """
+    def __init__(self, nsigma=5., warmup=5, min_sigma=1.):
+        self.nsigma = nsigma
+        self.warmup = warmup
+        self.min_sigma = min_sigma
+        self.reset()
+
+    def reset(self):
+        """ Discard all accumulated statistics. """
+        self.frames = 0
+        self.mean = None
+        self.count = None
+        self.spikes = None
+        self._m2 = None
+        self._warm = [] # frames held back during the warmup
+
+    def add(self, frame):
+        """
+        Add a frame to the running statistics.
+
+        Returns a boolean array, the same shape as ``frame``,
+        which is True where a spike was rejected.
+
+        """
+        frame = n.asarray(frame, dtype=float)
+        shape = self.mean.shape if self.mean is not None else \
+                self._warm[0].shape if self._warm else frame.shape
+        if frame.shape != shape:
+            raise ValueError('frame shape %s does not match %s' %
+                             (frame.shape, shape))
+        self.frames += 1
+        if self.mean is None:
+            self._warm.append(frame)
+            if len(self._warm) < max(self.warmup, 1):
+                return n.zeros(frame.shape, dtype=bool)
+            return self._seed()[-1]
+
+        delta = frame - self.mean
+        sigma = n.maximum(self.std, self.min_sigma)
+        spike = delta > self.nsigma * sigma
+        good = ~spike
+
+        # Welford update, only where the value was accepted
+        self.count += good
+        self.mean += n.where(good, delta / n.maximum(self.count, 1), 0.)
+        self._m2 += n.where(good, delta * (frame - self.mean), 0.)
+        self.spikes += spike
+        return spike
+
+    def finish(self):
+        """
+        Seed the statistics from the frames held back so far,
+        if the warmup isn't over yet. With a single frame, it
+        is taken as the mean.
+
+        Returns the spike masks of the held-back frames, stacked
+        in the order they were added, or None if none were held.
+
+        """
+        if not self._warm:
+            return None
+        return self._seed()
+
+    def _seed(self):
+        """
+        Start the statistics from the warmup frames, leaving out
+        any that are spikes compared to their median. Returns the
+        spike masks of all of them.
+
+        """
+        stack = n.array(self._warm)
+        self._warm = []
+        median = n.median(stack, axis=0)
+        # the MAD of a normal distribution is 0.6745 sigma
+        mad = n.median(abs(stack - median), axis=0) / 0.6745
+        sigma = n.maximum(mad, self.min_sigma)
+        spike = stack - median > self.nsigma * sigma
+        good = ~spike
+        self.count = good.sum(axis=0)
+        self.spikes = spike.sum(axis=0)
+        self.mean = n.where(good, stack, 0.).sum(axis=0) / self.count
+        self._m2 = n.where(good, (stack - self.mean) ** 2, 0.).sum(axis=0)
+        return spike
+
+    @property
+    def variance(self):
+        """ per-pixel sample variance of the accepted values """
+        if self._m2 is None:
+            return None
+        return self._m2 / n.maximum(self.count - 1, 1)
+
+    @property
+    def std(self):
+        """ per-pixel standard deviation of the accepted values """
+        if self._m2 is None:
+            return None
+        return n.sqrt(self.variance)
+
+def live_view(clnt, fps=30., autoscale=False):
+    """
+    Continuously display spectra from the CCD.
+
+    :param clnt: a :class:`labview_client` (or anything else
+                 with a ``get_spectrum`` method).
+    :param fps: maximum number of redraws per second.
+    :param autoscale: re-scale the axes when the data leaves
+                      the current view.
+
+    Spectra are acquired in a background thread, as fast as the
+    CCD can deliver them. The display only ever shows the most
+    recent one: frames that arrive between redraws are dropped
+    rather than queued. Redraws are throttled to ``fps``, and
+    only the line itself is re-rendered (blitted) over a cached
+    copy of the axes background, so the display keeps up with
+    the camera instead of the other way around.
+
+    Returns when the figure window is closed. If acquiring a
+    spectrum raises an exception, it is re-raised here.
+
+    """
+    import threading
+    import pylab as p
+    from time import time
+    from wanglib.pylab_extensions.live_plot import _outside_view
+
+    # the acquisition thread overwrites this with each new
+    # spectrum; the display takes whatever is there.
+    latest = [None]
+    error = [None]
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def acquire():
+        try:
+            while not stop.is_set():
+                spectrum = clnt.get_spectrum()
+                with lock:
+                    latest[0] = spectrum
+        except Exception as err:
+            # hand it to the display loop, which re-raises it
+            error[0] = err
+
+    wl,ccd = clnt.get_spectrum()
+    fig = p.figure()
+    ax = fig.gca()
+    line, = ax.plot(wl, ccd.sum(axis=0), animated=True)
+    canvas = fig.canvas
+
+    background = [None]
+    def on_draw(event):
+        # full redraws (resizes, rescales) invalidate the background
+        background[0] = canvas.copy_from_bbox(ax.bbox)
+        ax.draw_artist(line)
+    canvas.mpl_connect('draw_event', on_draw)
+    p.show(block=False)
+    canvas.draw()
+
+    thread = threading.Thread(target=acquire)
+    thread.daemon = True
+    thread.start()
+
+    interval = 1. / fps
+    try:
+        while p.fignum_exists(fig.number):
+            start = time()
+            with lock:
+                spectrum, latest[0] = latest[0], None
+            if error[0] is not None:
+                raise error[0]
+            if spectrum is not None:
+                wl,ccd = spectrum
+                y = ccd.sum(axis=0)
+                line.set_data(wl, y)
+                bounds = (n.nanmin(wl), n.nanmax(wl),
+                          n.nanmin(y), n.nanmax(y))
+                if autoscale and _outside_view(ax, bounds):
+                    ax.relim()
+                    ax.autoscale_view()
+                    canvas.draw()   # also recaptures the background
+                elif background[0] is not None:
+                    canvas.restore_region(background[0])
+                    ax.draw_artist(line)
+                    canvas.blit(ax.bbox)
+            # process GUI events for the rest of this frame
+            remaining = interval - (time() - start)
+            canvas.start_event_loop(max(remaining, 1e-3))
+    finally:
+        stop.set()
+
 if __name__ == "__main__":
     # for command line invocation, take the center wavelength
     # as first argument and put on a live display.
@@ -165,7 +423,10 @@ if __name__ == "__main__":
                       help='IP address of CCD server')
     parser.add_option('--autoscale', dest='autoscale',
                       default=False, action='store_true',
-                      help='Re-scale the axes on each acquisition')
+                      help='Re-scale the axes when data leaves the view')
+    parser.add_option('--fps', dest='fps', default=30.,
+                      type='float',
+                      help='Maximum display refresh rate')
     opts, args = parser.parse_args()
 
     # read center wl from command line
@@ -175,20 +436,5 @@ if __name__ == "__main__":
     clnt = labview_client(center_wl, host=opts.ip)
     #clnt = fake_ccd(center_wl)
 
-    # make a plot
-    p.ion()
-    p.hold(False)
-    wl,ccd = clnt.get_spectrum()
-    line, = p.plot(wl,ccd.sum(axis=0))
-    ax = line.get_axes()
-    first = True
-    while True:
-        # update it continuously
-        wl,ccd = clnt.get_spectrum()
-        line.set_ydata(ccd.sum(axis=0))
-        if opts.autoscale or first:
-            ax.relim()
-            ax.autoscale_view()
-            first=False
-        p.draw()
-
+    # display it continuously
+    live_view(clnt, fps=opts.fps, autoscale=opts.autoscale)
@@ -12,32 +12,48 @@ import numpy
 import Image
 import StringIO
 import xmlrpclib
+import hashlib
+import socket
+import struct
+from contextlib import contextmanager
 from wanglib.util import InstrumentError, calibration
 from time import sleep
 
-def sinewave(arg):
+def sinewave(arg, out=None):
     """
     oscillates between 0 and 1
     argument given in 2pi units
 
-    """
-    return 0.5 * (1 - numpy.sin(2 * numpy.pi * arg))
+    if an output array is given, compute in place there.
 
-def sawtooth(arg):
+    """
+    if out is None:
+        return 0.5 * (1 - numpy.sin(2 * numpy.pi * arg))
+    numpy.multiply(arg, 2 * numpy.pi, out=out)
+    numpy.sin(out, out=out)
+    numpy.subtract(1, out, out=out)
+    numpy.multiply(out, 0.5, out=out)
+    return out
+
+def sawtooth(arg, out=None):
     """
     gives values between 0 and 1
     argument given in 2pi units
 
+    if an output array is given, compute in place there.
+
     """
-    return numpy.remainder(arg,1.0)
+    return numpy.remainder(arg, 1.0, out=out)
 
-def zebra(arg):
+def zebra(arg, out=None):
     """
     switches between 0 and 1
     argument given in 2pi units
 
+    if an output array is given, compute in place there.
+
     """
-    return numpy.around(numpy.remainder(arg,1.0))
+    return numpy.around(numpy.remainder(arg, 1.0, out=out), out=out)
 
 options = { 
     # a registry of grating function types
@@ -52,6 +68,11 @@ class grating:
     function to produce a grating from an array of 
     pixel numbers (and optionally phase offsets).
 
+    When the pixel numbers are integers and the spacing is a whole
+    number of pixels, the grating repeats itself every ``spacing``
+    pixels along the coordinate axis, so only that many rows need
+    to be evaluated. See :meth:`lookup`.
+
     """
     def __init__(self, spacing, kind = "Sawtooth"):
         self.kind = kind
@@ -69,8 +90,50 @@ class grating:
     # parallel (perpendicular) to the grating axis
     # if phase is a scalar, it is not varied
 
+    def lookup(self, coordinate, phase = 0.0):
+        """
+        Row-lookup representation of the grating.
+
+        Returns a 2-tuple ``(table, index)`` such that
+        ``table[index]`` is the same as ``self(coordinate, phase)``.
+        ``table`` has one row per pixel in a single grating period,
+        and ``index`` says which of those rows each coordinate uses.
+
+        This is only possible when the grating is periodic on the
+        pixel grid - that is, ``coordinate`` is a 1-D array of whole
+        numbers, and ``spacing`` is a whole number (and neither is
+        being varied). Otherwise, returns None.
+
+        """
+        if self.variableSpacing or self.variablePhase:
+            return None
+        spacing = numpy.asarray(self.spacing)
+        coordinate = numpy.asarray(coordinate)
+        if spacing.ndim != 0 or coordinate.ndim != 1:
+            return None
+        period = int(abs(spacing))
+        if period == 0 or period != abs(spacing):
+            return None
+        if len(coordinate) <= period:
+            return None # nothing to be gained
+        if not numpy.all(numpy.around(coordinate) == coordinate):
+            return None
+
+        # coordinate / spacing is equal to index / period, up
+        # to an integer, which the grating functions ignore.
+        sign = 1 if spacing > 0 else -1
+        index = numpy.remainder(coordinate * sign, period).astype(int)
+        arg = numpy.add.outer(numpy.arange(period) / float(period), phase)
+        return options[self.kind](arg), index
+
     def __call__(self, coordinate, phase = 0.0):
         # phase is a(n array of) phase shifts
+
+        # if periodic, evaluate one period and repeat it
+        rows = self.lookup(coordinate, phase)
+        if rows is not None:
+            table, index = rows
+            return table.take(index, axis=0)
     
         # first find the unshifted argument
         if not self.variableSpacing:
@@ -89,14 +152,21 @@ class grating:
         # evaluate the function
         return options[self.kind](arg)
 
-def scale(value, factor, baseline=0):
+def scale(value, factor, baseline=0, out=None):
     """
     uniformly scale a value (or array)
     by a multiplicative factor (or array of factors)
     about a baseline value (or array of baselines)
 
+    if an output array is given, compute in place there.
+
     """
-    return factor * (value - baseline) + baseline 
+    if out is None:
+        return factor * (value - baseline) + baseline 
+    numpy.subtract(value, baseline, out=out)
+    numpy.multiply(out, factor, out=out)
+    numpy.add(out, baseline, out=out)
+    return out
 
 def maprange(value, targetrange):
     """
@@ -109,6 +179,96 @@ def maprange(value, targetrange):
     bottom = targetrange[0]
     return ((top - bottom) * value) + bottom
 
+def graytable(targetrange, size=1024, curve=None):
+    """
+    tabulate maprange over [0,1], rounded to uint8 gray levels.
+
+    returns a lookup table of length ``size``, for use
+    with :func:`quantize`. entry i holds the gray level
+    for the middle of the bin [i/size, (i+1)/size).
+
+    if a measured calibration ``curve`` is given, as a 2-tuple
+    ``(values, grays)`` of increasing values in [0,1] and the
+    gray levels that produce them, gray levels are interpolated
+    from it instead, and targetrange is ignored.
+
+    """
+    centers = (numpy.arange(size) + 0.5) / size
+    if curve is None:
+        levels = maprange(centers, targetrange)
+    else:
+        values, grays = curve
+        levels = numpy.interp(centers, values, grays)
+    return numpy.uint8(numpy.clip(numpy.around(levels), 0, 255))
+
+def phasetable(kind, table, size=1024, factor=1.0, baseline=0.0):
+    """
+    tabulate a grating function over one period, in gray levels.
+
+    ``kind`` is one of the keys of grating.options, and ``table``
+    a gray-level table from :func:`graytable`. the result has
+    ``size`` entries, one for each step of phase (in 2pi/size
+    units), holding the gray level for the grating value there
+    after scaling by ``factor`` about ``baseline``.
+
+    with this, a grating can be rendered by quantizing phase to
+    an integer and looking it up - see :func:`phaselookup`.
+
+    """
+    centers = (numpy.arange(size) + 0.5) / size
+    values = scale(options[kind](centers), factor, baseline)
+    return quantize(values, table)
+
+def phaselookup(arg, table, out=None, index=None):
+    """
+    render a grating from its argument, using a table
+    made by :func:`phasetable`.
+
+    ``arg`` is given in 2pi units, and is quantized to
+    ``len(table)`` steps per period (which should be a power
+    of two). if given, ``out`` (uint8) and ``index`` (int)
+    arrays of the same shape as ``arg`` are filled in place.
+
+    """
+    size = len(table)
+    if index is None:
+        index = numpy.empty(numpy.shape(arg), dtype=int)
+    # round down (casting alone would round negatives up)
+    steps = numpy.multiply(arg, size)
+    numpy.floor(steps, out=steps)
+    index[...] = steps
+    # wrap to a single period
+    numpy.bitwise_and(index, size - 1, out=index)
+    return table.take(index, out=out)
+
+def quantize(value, table, out=None, index=None):
+    """
+    map an array of values in [0,1] to gray levels
+    using a lookup table made by :func:`graytable`.
+
+    values outside [0,1] are clipped, rather than wrapped.
+    if an output (uint8) array is given, fill it in place.
+    likewise, an integer array of the same shape as ``value``
+    can be given as ``index`` to avoid allocating one.
+
+    """
+    size = len(table)
+    if index is None:
+        index = numpy.empty(numpy.shape(value), dtype=int)
+    numpy.multiply(value, size, out=index, casting='unsafe')
+    numpy.clip(index, 0, size - 1, out=index)
+    return table.take(index, out=out)
+
+imageformats = {
+    # a registry of ways to encode patterns for the display server.
+    # values are (PIL format, PIL save options), or None for
+    # raw uint8 pixels with no container at all.
+    "PNG": ("PNG", {}),
+    "PNG-fast": ("PNG", {"compress_level": 1}),
+    "BMP": ("BMP", {}),
+    "raw": None,
+    }
+
 class pattern(object):
     """
     Boilerplate class for specialized gratings
@@ -129,15 +289,33 @@ class pattern(object):
         encodeimage -- a method that basically saves the PIL
                         image encoded as a file (default PNG)
                         in memory.
+        gray -- the array quantized to uint8 gray levels.
 
     Display-server compatibility:
         setproxy -- set the server proxy to display
                     these images at
         senddata -- send the current image data to the 
                     display server
+        imageformat -- how senddata encodes the image. One of
+                    the keys of grating.imageformats: 'PNG'
+                    (default), 'PNG-fast' (low compression),
+                    'BMP' (uncompressed), or 'raw' (bare pixels,
+                    needs a display server with setRawImageData).
+        hold -- a context manager which holds back updates, so
+                    that several attribute changes go out as
+                    one transmission.
+        usecache -- if True (default), images the display server
+                    has already seen are re-shown by ID instead
+                    of being uploaded again.
+
+    Gray levels come from a lookup table, and the gray and
+    encoding buffers are reused from frame to frame.
+
+    For testing without a monitor, :class:`display_server` is a
+    stand-in which can be given in place of a server address.
 
     """
-    def __init__(self, dim=(1890,1020), server=None):
+    def __init__(self, dim=(1890,1020), server=None, imageformat='PNG'):
         """
         Set core parameters of the pattern.
 
@@ -149,16 +327,52 @@ class pattern(object):
             server -- a string containing the address of the 
                     display server where the pattern will
                     be displayed. Default: None.
+            imageformat -- encoding to use when sending images to
+                    the display server. Default: 'PNG'.
 
         """
         self.dim = dim
         self._grayrange = (0,255)
+        self._graycurve = None
+        self._graytable = graytable(self._grayrange)
+        self._grayversion = 0 # bumped whenever the gray table changes
+        self._gray = None
+        self._index = None
+        self._encoded = StringIO.StringIO()
+        self.imageformat = imageformat
+        self.usecache = True
+        self._held = 0
+        self._pending = False
         self.setproxy(server)
 
     def update(self):
         """call this whenever an attribute is changed. """
-        if self.proxy is not None:
-            self.senddata()
+        if self._held:
+            self._pending = True
+        elif self.proxy is not None:
+            self.senddata(force=False)
+
+    @contextmanager
+    def hold(self):
+        """
+        Hold back updates until the end of a block.
+
+        >>> with ps.hold():
+        ...     ps.phase = newphase
+        ...     ps.amp = newamp
+
+        sends one image at the end, instead of one per
+        attribute. Blocks can be nested.
+
+        """
+        self._held += 1
+        try:
+            yield self
+        finally:
+            self._held -= 1
+        if not self._held and self._pending:
+            self._pending = False
+            self.update()
 
     @property
     def grayrange(self):
@@ -166,6 +380,27 @@ class pattern(object):
     @grayrange.setter
     def grayrange(self, val):
         self._grayrange = val
+        self._graytable = graytable(val, curve=self._graycurve)
+        self._grayversion += 1
+        self.update()
+
+    @property
+    def graycurve(self):
+        """
+        Measured gray-level calibration of the SLM, or None.
+
+        A 2-tuple ``(values, grays)``: the pattern values (0 to 1,
+        increasing) produced by the gray levels in ``grays``. When
+        set, gray levels are interpolated from this curve instead
+        of being mapped linearly onto ``grayrange``.
+
+        """
+        return self._graycurve
+    @graycurve.setter
+    def graycurve(self, val):
+        self._graycurve = val
+        self._graytable = graytable(self._grayrange, curve=val)
+        self._grayversion += 1
         self.update()
 
     def setproxy(self, server_address):
@@ -179,12 +414,27 @@ class pattern(object):
         >>> pattern.setproxy("http://localhost:8000")
         >>> eg.proxy
         <ServerProxy for localhost:8000>
+
+        Addresses like "tcp://localhost:8001" use the binary
+        :class:`socket_proxy` instead of XML-RPC. Anything other
+        than a string (such as a :class:`display_server`) is used
+        as the proxy directly.
         
         """
-        if server_address is not None:
-            self.proxy = xmlrpclib.ServerProxy(str(server_address))
-        else:
+        if server_address is None:
             self.proxy = None
+        elif isinstance(server_address, basestring):
+            if server_address.startswith('tcp://'):
+                host, port = server_address[len('tcp://'):].split(':')
+                self.proxy = socket_proxy(host, int(port))
+            else:
+                self.proxy = xmlrpclib.ServerProxy(str(server_address))
+        else:
+            self.proxy = server_address
+        # what the display server is showing, and has cached
+        self._shown = None
+        self._cached = set()
+        self._sequence = (), ()
 
     @property
     def array_(self):
@@ -198,46 +448,425 @@ class pattern(object):
         """
         return numpy.random.random(self.dim)
 
+    @property
+    def rows(self):
+        """
+        Row-lookup form of the pattern, ``(table, index)``.
+
+        Children that can represent their array as a few distinct
+        rows should override this; ``index`` of None means
+        ``table`` is the whole array.
+
+        """
+        return self.array_, None
+
+    @property
+    def gray(self):
+        """
+        The pattern, quantized to uint8 gray levels.
+
+        This is a buffer that gets overwritten on the next access.
+
+        """
+        table, index = self.rows
+        if index is not None:
+            # quantize the distinct rows, then expand
+            shape = (len(index),) + table.shape[1:]
+            table = quantize(table, self._graytable)
+        else:
+            shape = table.shape
+        if self._gray is None or self._gray.shape != shape:
+            self._gray = numpy.empty(shape, dtype=numpy.uint8)
+        if index is not None:
+            table.take(index, axis=0, out=self._gray)
+        else:
+            if self._index is None or self._index.shape != shape:
+                self._index = numpy.empty(shape, dtype=int)
+            quantize(table, self._graytable,
+                     out=self._gray, index=self._index)
+        return self._gray
+
     @property
     def image(self):
         """
         A PIL representation of the pattern in grayscale mode
 
         """
-        grarray = numpy.int8(maprange(self.array_, self.grayrange))
-        return Image.fromarray(grarray, 'L')
+        return Image.fromarray(self.gray, 'L')
 
     def encodeimage(self, form='PNG'):
         """
         return a file-like image of the specified format
         note: does not support "with ... as ..." syntax
 
+        form can be a PIL format name, or one of the keys
+        of grating.imageformats. the buffer is reused, so
+        read it before encoding the next image.
+
         """
-        buf = StringIO.StringIO()
-        self.image.save(buf, format=form)
+        return self._encode(self.gray, form)
+
+    def _encode(self, gray, form):
+        """ encode an array of gray levels into the reused buffer """
+        buf = self._encoded
+        buf.seek(0)
+        buf.truncate()
+        if form in imageformats:
+            form = imageformats[form]
+        else:
+            form = (form, {})
+        if form is None:
+            buf.write(gray.tostring())
+        else:
+            form, kwargs = form
+            Image.fromarray(gray, 'L').save(buf, format=form, **kwargs)
         buf.seek(0)
         return buf
 
     # now properties shortcut to formats
     png = property(encodeimage)
 
-    def senddata(self, throw=True):
+    def senddata(self, throw=True, force=True):
         """
         Send image data to the display server.
 
         If throw = False is given, will fail silently
         if there is no display server.
 
+        Images are identified by a hash of their gray levels.
+        Only the ID is sent if the display server has the image
+        cached (see ``usecache``). With force = False, nothing
+        is sent if the image is already on display; :meth:`update`
+        uses this to skip changes that leave the mask the same.
+        Raises InstrumentError if the server fails to show it.
+
         """
-        if self.proxy is not None:
-            data = xmlrpclib.Binary(self.png.read())
+        if self.proxy is None:
+            if throw:
+                raise InstrumentError("No display server defined")
+            return
+        self._display(self.gray, force=force)
+
+    def _display(self, gray, key=None, force=True):
+        """ put an array of gray levels on the display server """
+        if key is None:
+            key = imagekey(gray)
+        if key == self._shown and not force:
+            return
+        self._shown = None # until the server says otherwise
+        if self.usecache and key in self._cached:
+            if self._call('showImage', key):
+                self._shown = key
+                return
+            # server must have dropped it from its cache
+            self._cached.discard(key)
+
+        data = xmlrpclib.Binary(self._encode(gray, self.imageformat).read())
+        if imageformats.get(self.imageformat, ()) is None:
+            height, width = gray.shape
+            method, args = 'RawImageData', (data, width, height)
+        else:
+            method, args = 'ImageData', (data,)
+        cached = False
+        if self.usecache:
             try:
-                self.proxy.setImageData(data)
-            except xmlrpclib.ProtocolError:
-                print 'error talking to display server, retrying once'
-                self.proxy.setImageData(data)
-        elif throw:
+                cached = self._call('cache' + method, key, *args)
+            except xmlrpclib.Fault as err:
+                if 'not supported' not in err.faultString:
+                    raise InstrumentError('display server error: %s'
+                                          % err.faultString)
+            except AttributeError:
+                pass
+            if cached:
+                self._cached.add(key)
+                self._shown = key
+                return
+        if self._call('set' + method, *args) is False:
+            raise InstrumentError('display server could not show image')
+        if self.usecache:
+            # setting worked where caching didn't
+            print 'display server has no image cache, disabling'
+            self.usecache = False
+        self._shown = key
+
+    def preload(self, masks):
+        """
+        Upload a sequence of masks to the display server's cache.
+
+        ``masks`` is a stack of gray-level arrays, such as
+        :meth:`pulseshaper.render` makes. Once loaded, show
+        them by index with :meth:`showframe`, which only
+        sends the ID of the mask.
+
+        Caching a mask also displays it, so the last mask
+        of the sequence is left on display.
+
+        Returns the list of mask IDs. Raises InstrumentError
+        if the display server has no image cache (or ``usecache``
+        is off), since every frame would then be sent in full.
+
+        """
+        if self.proxy is None:
             raise InstrumentError("No display server defined")
+        if not self.usecache:
+            raise InstrumentError("Image caching is disabled")
+        keys = [imagekey(gray) for gray in masks]
+        for gray, key in zip(masks, keys):
+            self._display(gray, key)
+            if not self.usecache:
+                raise InstrumentError("Display server has no image cache")
+        self._sequence = masks, keys
+        return keys
+
+    def showframe(self, i):
+        """ Display mask number ``i`` of the preloaded sequence. """
+        masks, keys = self._sequence
+        self._display(masks[i], keys[i])
+
+    def _call(self, method, *args):
+        """ call a display server method, retrying once """
+        func = getattr(self.proxy, method)
+        try:
+            return func(*args)
+        except xmlrpclib.ProtocolError:
+            print 'error talking to display server, retrying once'
+            return func(*args)
+
+def imagekey(gray):
+    """ an ID string for an array of gray levels """
+    gray = numpy.ascontiguousarray(gray)
+    digest = hashlib.sha1(str(gray.shape))
+    digest.update(gray)
+    return digest.hexdigest()
+
+def _unwrap(data):
+    """ get the bytes out of an xmlrpclib.Binary """
+    return data.data if isinstance(data, xmlrpclib.Binary) else data
+
+class display_server(object):
+    """
+    Stand-in for the SLM display server.
+
+    Implements the same methods as the real thing, but keeps the
+    displayed image as an array instead of showing it. Use it for
+    testing patterns without an SLM:
+
+    >>> server = display_server()
+    >>> ps = pulseshaper(server=server)
+    >>> server.image    # the gray levels on "display"
+
+    Every call is counted in ``calls``, a dictionary from method
+    name to number of calls. To serve it over XML-RPC like the
+    real thing, use :meth:`serve`.
+
+    Images are cached by ID, up to ``cachesize`` of them (oldest
+    dropped first).
+
+    """
+    def __init__(self, cachesize=256):
+        self.cachesize = cachesize
+        self.image = None
+        self.cache = {}
+        self._order = []
+        self.calls = {}
+
+    def _count(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    def _decode(self, data):
+        return numpy.asarray(Image.open(StringIO.StringIO(_unwrap(data))))
+
+    def _decoderaw(self, data, width, height):
+        gray = numpy.frombuffer(_unwrap(data), dtype=numpy.uint8)
+        return gray.reshape((height, width))
+
+    def _store(self, key, image):
+        if key not in self.cache:
+            self._order.append(key)
+        self.cache[key] = image
+        while len(self._order) > self.cachesize:
+            del self.cache[self._order.pop(0)]
+        self.image = image
+        return True
+
+    def setImageData(self, data):
+        self._count('setImageData')
+        self.image = self._decode(data)
+        return True
+
+    def setRawImageData(self, data, width, height):
+        self._count('setRawImageData')
+        self.image = self._decoderaw(data, width, height)
+        return True
+
+    def cacheImageData(self, key, data):
+        self._count('cacheImageData')
+        return self._store(key, self._decode(data))
+
+    def cacheRawImageData(self, key, data, width, height):
+        self._count('cacheRawImageData')
+        return self._store(key, self._decoderaw(data, width, height))
+
+    def showImage(self, key):
+        self._count('showImage')
+        if key not in self.cache:
+            return False
+        self.image = self.cache[key]
+        return True
+
+    def serve(self, port=8000):
+        """ serve this object over XML-RPC, forever. """
+        from SimpleXMLRPCServer import SimpleXMLRPCServer
+        server = SimpleXMLRPCServer(('', port), logRequests=False,
+                                    allow_none=True)
+        server.register_instance(self)
+        server.serve_forever()
+
+    def serve_frames(self, port=8001):
+        """
+        serve this object over the binary protocol used by
+        :class:`socket_proxy`, forever.
+
+        one client is handled at a time, for as long as it
+        stays connected. a request that fails (an unknown op,
+        or an image that won't decode) is answered with a 0
+        and the connection stays open.
+
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('', port))
+        listener.listen(1)
+        while True:
+            conn, addr = listener.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                while True:
+                    header = _recvall(conn, _frame_header.size)
+                    if not header:
+                        break # client hung up
+                    op, keylen, width, height, datalen = \
+                            _frame_header.unpack(header)
+                    key = _recvall(conn, keylen)
+                    data = _recvall(conn, datalen)
+                    try:
+                        method = _frame_ops[op]
+                        args = {'set': (data,),
+                                'setRaw': (data, width, height),
+                                'cache': (key, data),
+                                'cacheRaw': (key, data, width, height),
+                                'show': (key,)}[method]
+                        ok = getattr(self, _frame_methods[method])(*args)
+                    except Exception as err:
+                        print 'display server: bad request (%s)' % err
+                        ok = False
+                    conn.sendall('\x01' if ok else '\x00')
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+
+# binary frame protocol: a fixed header, then the image key
+# (if any), then the image data (if any). The server replies
+# with one byte, 1 for success and 0 for failure.
+#   op (byte), key length (byte), width, height (shorts),
+#   data length (int), all big-endian.
+_frame_header = struct.Struct('!BBHHI')
+_frame_ops = {1: 'set', 2: 'setRaw', 3: 'cache', 4: 'cacheRaw', 5: 'show'}
+_frame_codes = dict((v, k) for k, v in _frame_ops.items())
+_frame_methods = {'set': 'setImageData',
+                  'setRaw': 'setRawImageData',
+                  'cache': 'cacheImageData',
+                  'cacheRaw': 'cacheRawImageData',
+                  'show': 'showImage'}
+
+def _recvall(sock, size):
+    """
+    read exactly ``size`` bytes from a socket.
+
+    returns an empty string if the connection is closed
+    before anything is read.
+
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    got = 0
+    while got < size:
+        n = sock.recv_into(view[got:], size - got)
+        if n == 0:
+            if got == 0:
+                return ''
+            raise socket.error('connection closed mid-frame')
+        got += n
+    return str(buf)
+
+class socket_proxy(object):
+    """
+    Display server proxy using a persistent TCP connection.
+
+    Has the same methods as the XML-RPC proxy, but sends raw
+    image bytes with a small binary header instead of
+    base64-encoded XML, and keeps one connection open rather
+    than making a new HTTP request per image.
+
+    >>> ps = pulseshaper(server='tcp://localhost:8001')
+
+    The other end should be a server speaking the same
+    protocol, such as :meth:`display_server.serve_frames`.
+
+    """
+    def __init__(self, host, port=8001):
+        self.host = host
+        self.port = port
+        self.sock = None
+
+    def connect(self):
+        """ (re)open the connection to the server. """
+        self.close()
+        self.sock = socket.create_connection((self.host, self.port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _send(self, method, key='', data='', width=0, height=0):
+        data = _unwrap(data)
+        header = _frame_header.pack(_frame_codes[method], len(key),
+                                    width, height, len(data))
+        for attempt in (1, 2):
+            try:
+                if self.sock is None:
+                    self.connect()
+                self.sock.sendall(header + key)
+                if data:
+                    self.sock.sendall(data)
+                reply = _recvall(self.sock, 1)
+                if not reply:
+                    raise socket.error('display server hung up')
+                return reply == '\x01'
+            except socket.error:
+                self.close()
+                if attempt == 2:
+                    raise InstrumentError(
+                        'error talking to display server')
+
+    def setImageData(self, data):
+        return self._send('set', data=data)
+
+    def setRawImageData(self, data, width, height):
+        return self._send('setRaw', data=data,
+                          width=width, height=height)
+
+    def cacheImageData(self, key, data):
+        return self._send('cache', key, data)
+
+    def cacheRawImageData(self, key, data, width, height):
+        return self._send('cacheRaw', key, data, width, height)
+
+    def showImage(self, key):
+        return self._send('show', key)
 
 class deflector(pattern):
     """
@@ -254,8 +883,29 @@ class deflector(pattern):
         th -- orientation of the grating, in radians.
         phase -- phase of the grating
 
+    The rotated coordinate grid is cached, and only recomputed
+    when ``dim`` or ``deg`` change. The pattern itself is computed
+    in single precision, in place, in a buffer that is reused from
+    one update to the next - so sweeping ``phase`` or ``spacing``
+    allocates nothing.
+
+    Gray levels are rendered straight from the grating phase,
+    quantized to ``phaselevels`` steps per period and looked up in
+    a table that folds in ``kind``, the brightness controls, and
+    the gray-level calibration (see :func:`phasetable`).
+
     """
+    phaselevels = 1024 # must be a power of two
+
     def __init__(self, *args, **kwargs):
+        # cached coordinate grid and output buffer
+        self._grid = None
+        self._gridkey = None
+        self._buffer = None
+        # cached phase -> gray table
+        self._phasetable = None
+        self._phasekey = None
+
         super(deflector,self).__init__(*args, **kwargs)
 
         # grating parameters:
@@ -278,20 +928,81 @@ class deflector(pattern):
 
     @property
     def grid(self):
-        x, y = numpy.arange(self.dim[1]), numpy.arange(self.dim[0])
-        xax, yax = numpy.meshgrid(x, y)
-        return xax*numpy.sin(self.th) + yax*numpy.cos(self.th)
+        """
+        pixel coordinate along the grating axis (float32).
+
+        cached until ``dim`` or ``deg`` change.
+
+        """
+        key = (tuple(self.dim), self.deg)
+        if key != self._gridkey:
+            x = numpy.arange(self.dim[1], dtype=numpy.float32)
+            y = numpy.arange(self.dim[0], dtype=numpy.float32)
+            sin = numpy.float32(numpy.sin(self.th))
+            cos = numpy.float32(numpy.cos(self.th))
+            # same as meshgrid, but broadcasting the two 1-D axes
+            self._grid = (x * sin)[numpy.newaxis, :] + \
+                         (y * cos)[:, numpy.newaxis]
+            self._gridkey = key
+        return self._grid
 
     @property
     def array_(self):
-        # make a grating instance:
-        func = grating(self.spacing, self.kind)
-        # using said instance, generate a pattern:
-        array_ = func(self.grid,self.phase)
+        """
+        the pattern, as a float32 array.
+
+        this is a buffer that gets overwritten on the next access,
+        so copy it if you want to keep it around.
+
+        """
+        grid = self.grid
+        if self._buffer is None or self._buffer.shape != grid.shape:
+            self._buffer = numpy.empty(grid.shape, dtype=numpy.float32)
+        array_ = self._buffer
+        # grating argument, in 2pi units
+        numpy.divide(grid, self.spacing, out=array_)
+        numpy.add(array_, self.phase, out=array_)
+        # evaluate the grating function
+        options[self.kind](array_, out=array_)
         # scale the output (amplitude-modulate)
-        array_ = scale(array_,self.scalefactor,self.baseline)
+        scale(array_, self.scalefactor, self.baseline, out=array_)
         return array_
 
+    @property
+    def gray(self):
+        """
+        The pattern, as uint8 gray levels.
+
+        Computed with a phase lookup table rather than from
+        :attr:`array_`. For a sawtooth the two agree exactly; other
+        kinds are sampled at the middle of each phase step, so may
+        differ by a gray level. This is a buffer that gets
+        overwritten on the next access.
+
+        """
+        # the gray table is replaced whenever grayrange changes
+        key = (self.kind, self.scalefactor, self.baseline,
+               self.phaselevels, self._grayversion)
+        if key != self._phasekey:
+            self._phasetable = phasetable(self.kind, self._graytable,
+                                          self.phaselevels,
+                                          self.scalefactor, self.baseline)
+            self._phasekey = key
+
+        grid = self.grid
+        if self._buffer is None or self._buffer.shape != grid.shape:
+            self._buffer = numpy.empty(grid.shape, dtype=numpy.float32)
+        if self._gray is None or self._gray.shape != grid.shape:
+            self._gray = numpy.empty(grid.shape, dtype=numpy.uint8)
+        if self._index is None or self._index.shape != grid.shape:
+            self._index = numpy.empty(grid.shape, dtype=int)
+        # grating argument, in 2pi units
+        arg = self._buffer
+        numpy.divide(grid, self.spacing, out=arg)
+        numpy.add(arg, self.phase, out=arg)
+        return phaselookup(arg, self._phasetable,
+                           out=self._gray, index=self._index)
+
 class pulseshaper(pattern):
     """
     Vertically-deflecting grating with
@@ -373,12 +1084,83 @@ class pulseshaper(pattern):
         self.update()
 
     @property
-    def array_(self):
+    def rows(self):
+        """
+        Compact form of :attr:`array_`.
+
+        A 2-tuple ``(table, index)`` such that ``table[index]``
+        is the pattern. When the grating spacing is a whole number
+        of pixels, ``table`` holds just one grating period - so
+        it is ``spacing`` rows tall instead of ``dim[1]``, and the
+        phase and amplitude profiles are applied only to those rows.
+
+        """
         gd = -1 if self.deflect_up else 1
         # the following works due to some crazy fucked up shit I wrote
         # in 2010 defining the "grating" class above
         # i must have been smoking crack
-        return self.grating(gd * self.y, self.phase) * self.amp
+        rows = self.grating.lookup(gd * self.y, self.phase)
+        if rows is None:
+            table = self.grating(gd * self.y, self.phase)
+            rows = table, numpy.arange(len(table))
+        table, index = rows
+        return table * self.amp, index
+
+    @property
+    def array_(self):
+        table, index = self.rows
+        return table.take(index, axis=0)
+
+    def render(self, phases, amps=None, out=None):
+        """
+        Render a whole stack of masks at once.
+
+        :param phases: phase profiles (2pi units), one per mask.
+                       shape: (N, dim[0])
+        :param amps: amplitude profiles, one per mask, or a single
+                     profile for all of them. Default: current amp.
+        :param out: uint8 array, or numpy.memmap, to render into.
+                    shape: (N, dim[1], dim[0])
+        :returns: the masks as gray levels, like :attr:`gray`.
+
+        The shaper's own attributes are left alone. To play the
+        masks back, upload them with :meth:`preload` and step
+        through them with :meth:`showframe`:
+
+        >>> phases = [ps.x * k * 1e-3 for k in range(100)]
+        >>> ps.preload(ps.render(phases))
+        >>> ps.showframe(42)
+
+        """
+        phases = numpy.atleast_2d(phases)
+        if amps is None:
+            amps = self.amp
+        amps = 1.0 * numpy.asarray(amps)
+        phases, amps = numpy.broadcast_arrays(phases, amps)
+        n = len(phases)
+        shape = (n, len(self.y), len(self.x))
+        if out is None:
+            out = numpy.empty(shape, dtype=numpy.uint8)
+        elif out.shape != shape:
+            raise ValueError('out should have shape %s' % (shape,))
+
+        gd = -1 if self.deflect_up else 1
+        # a few masks at a time, to bound the size of the tables
+        chunk = 16
+        for start in range(0, n, chunk):
+            stop = min(start + chunk, n)
+            rows = self.grating.lookup(gd * self.y, phases[start:stop])
+            if rows is None:
+                for i in range(start, stop):
+                    array_ = self.grating(gd * self.y, phases[i]) * amps[i]
+                    quantize(array_, self._graytable, out=out[i])
+                continue
+            # tables are (period, masks, x)
+            table, index = rows
+            table = quantize(table * amps[start:stop], self._graytable)
+            for i in range(start, stop):
+                table[:, i - start].take(index, axis=0, out=out[i])
+        return out
 
     def blink(self, interval = 1.0):
         """ blink the grating on and off (for alignment)"""
@@ -393,7 +1175,6 @@ class pulseshaper(pattern):
                 self.amp = orig
                 break
 
-from pylab import imshow
 def show(*args, **kwargs):
     """
     imshow alternative that makes slm-specific tweaks.
@@ -402,6 +1183,7 @@ def show(*args, **kwargs):
     and turns off the axis labels.
 
     """
+    from pylab import imshow
     if 'cmap' not in kwargs:
         kwargs['cmap'] = 'gray'
     ax = imshow(*args, **kwargs)
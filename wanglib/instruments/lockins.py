@@ -26,8 +26,197 @@ corresponding classes.
 """
 
 from wanglib.util import InstrumentError, sciround
+from time import sleep, time
+from math import exp
+import numpy
 
-class srs830(object):
+def settle_factor(poles, accuracy=0.99):
+    """
+    Number of time constants for a chain of identical low-pass
+    filters to settle to within `accuracy` of a step.
+
+    :param poles: number of filter stages (slope / 6 dB/octave).
+    :param accuracy: fraction of the step to settle to.
+
+    The step response of ``n`` stages is one minus
+    exp(-t) * (1 + t + t**2/2! + ... + t**(n-1)/(n-1)!),
+    which we solve for ``t`` by bisection.
+
+    """
+    def response(t):
+        term, total = 1., 1.
+        for k in range(1, poles):
+            term *= t / k
+            total += term
+        return 1. - exp(-t) * total
+    lo, hi = 0., 1.
+    while response(hi) < accuracy:
+        hi *= 2
+    for i in range(50):
+        mid = (lo + hi) / 2
+        if response(mid) < accuracy:
+            lo = mid
+        else:
+            hi = mid
+    return hi
+
+class _lockin(object):
+    """
+    Sensitivity and time constant functions common to both lock-ins.
+
+    Subclasses provide ``sensitivities`` and ``timeconsts`` tables,
+    mapping codes to (value, unit) tuples, and the commands to set
+    and query them.
+
+    """
+
+    _V_scales = {'V': 1.,
+                'mV': 1e-3,
+                'uV': 1e-6,
+                'nV': 1e-9}
+
+    _T_scales = {'ks': 1e3,
+                 's': 1.,
+                 'ms': 1e-3,
+                 'us': 1e-6,
+                 'MIN': 0.}
+
+    sensitivity_ttl = None
+    """ Seconds before the cached sensitivity is re-read (None: never). """
+
+    _sens_code = None  # cached sensitivity code
+    _sens_time = 0.    # when it was read
+
+    # sensitivity functions
+
+    def get_sensitivity(self, unit='V', refresh=False):
+        """
+        Get the current sensitivity, in Volts.
+
+        >>> li.get_sensitivity()
+        0.1
+
+        If the `unit` kwarg is specified, the value will
+        be converted to the desired unit instead.
+
+        >>> li.get_sensitivity(unit='uV')
+        100000.
+
+        Using `unit=True` will return a value in a 2-tuple
+        along with the most sensible unit (as a string).
+
+        >>> li.get_sensitivity(unit=True)
+        (100, 'mV')
+
+        This uses the cached value unless it has expired, or
+        `refresh` is True.
+
+        """
+        q,u = self.sensitivities[self._get_sensitivity_code(refresh)]
+        if unit in self._V_scales.keys():
+            sens = q * self._V_scales[u] / self._V_scales[unit]
+            return sciround(sens, 1)
+        else:
+            return q,u
+    def set_sensitivity(self,code):
+        """Set the current sensitivity (Using a code)."""
+        self.bus.write(self._sens_cmd % code)
+        self._sens_code = code
+        self._sens_time = time()
+    def _get_sensitivity_code(self, refresh=False):
+        """ the sensitivity code, from the cache if it's still good """
+        expired = (self.sensitivity_ttl is not None and
+                   time() - self._sens_time > self.sensitivity_ttl)
+        if refresh or expired or self._sens_code is None:
+            self._sens_code = int(self.bus.ask(self._sens_query))
+            self._sens_time = time()
+        return self._sens_code
+    sensitivity = property(get_sensitivity,set_sensitivity)
+    """ Current value of the sensitivity, in volts. """
+    #TODO: set with a value in volts
+
+    def _sensitivity_volts(self, code):
+        """ the sensitivity for a code, in volts """
+        q,u = self.sensitivities[code]
+        return q * self._V_scales[u]
+
+    # time constant functions
+
+    def get_timeconst(self):
+        """Get the current time constant (as a 2-tuple)."""
+        val = self.bus.ask(self._tc_query)
+        return self.timeconsts[int(val)]
+    def set_timeconst(self,code):
+        """Set the current time constant (Using a code)."""
+        self.bus.write(self._tc_cmd % code)
+        self._settle = None
+    timeconst = property(get_timeconst,set_timeconst)
+    """
+    Current value of the time constant as a 2-tuple.
+
+    """
+
+    def _timeconst_seconds(self):
+        """ the current time constant, in seconds """
+        q,u = self.get_timeconst()
+        return q * self._T_scales[u]
+
+    # filter slope functions
+
+    def get_slope(self):
+        """Get the output filter slope, in dB/octave."""
+        val = self.bus.ask(self._slope_query)
+        return self.slopes[int(val)]
+    def set_slope(self,code):
+        """Set the output filter slope (Using a code)."""
+        self.bus.write(self._slope_cmd % code)
+        self._settle = None
+    slope = property(get_slope,set_slope)
+    """ Current output filter slope, in dB/octave. """
+
+    # settling
+
+    _settle = None  # cached (accuracy, seconds)
+
+    def settle_time(self, accuracy=0.99, refresh=False):
+        """
+        Time for the output to settle after a step in the input.
+
+        :param accuracy: fraction of the step to settle to.
+        :param refresh: re-read the time constant and filter slope.
+        :returns: settling time, in seconds.
+
+        This depends on the time constant and on the filter slope:
+        each 6 dB/octave is another low-pass stage, so steeper
+        filters take more time constants to settle (to 99%: 4.6,
+        6.6, 8.4 and 10 time constants, from 6 to 24 dB/octave).
+
+        The result is cached until the time constant or slope is
+        changed through this object, or `refresh` is True.
+
+        """
+        if refresh or self._settle is None or self._settle[0] != accuracy:
+            poles = self.get_slope() // 6
+            seconds = self._timeconst_seconds() * settle_factor(poles,
+                                                                accuracy)
+            self._settle = (accuracy, seconds)
+        return self._settle[1]
+
+    def wait_settled(self, accuracy=0.99):
+        """
+        Wait for the output to settle (see :meth:`settle_time`).
+
+        Call this after changing what is being measured, instead of
+        sleeping for a fixed time. It can be given to
+        :func:`wanglib.util.scanner` as the ``lag``:
+
+        >>> gen = scanner(wls, set=tr.set_wl, get=li.get_x,
+        ...               lag=li.wait_settled)
+
+        """
+        sleep(self.settle_time(accuracy))
+
+class srs830(_lockin):
     """ A Stanford Research Systems model SR830 DSP lock-in.
 
     Typically controlled over GPIB, address 8. Instantiate like:
@@ -42,6 +231,73 @@ class srs830(object):
     def __init__(self, bus):
         self.bus = bus
 
+    # sensitivity functions
+
+    sensitivities = {0: (2,'nV'),
+                     1: (5,'nV'),
+                     2: (10,'nV'),
+                     3: (20,'nV'),
+                     4: (50,'nV'),
+                     5: (100,'nV'),
+                     6: (200,'nV'),
+                     7: (500,'nV'),
+                     8: (1,'uV'),
+                     9: (2,'uV'),
+                     10: (5,'uV'),
+                     11: (10,'uV'),
+                     12: (20,'uV'),
+                     13: (50,'uV'),
+                     14: (100,'uV'),
+                     15: (200,'uV'),
+                     16: (500,'uV'),
+                     17: (1,'mV'),
+                     18: (2,'mV'),
+                     19: (5,'mV'),
+                     20: (10,'mV'),
+                     21: (20,'mV'),
+                     22: (50,'mV'),
+                     23: (100,'mV'),
+                     24: (200,'mV'),
+                     25: (500,'mV'),
+                     26: (1,'V')}
+
+    _sens_cmd = "SENS %d"
+    _sens_query = "SENS?"
+
+    # time constant functions
+
+    timeconsts = {0: (10,'us'),
+                  1: (30,'us'),
+                  2: (100,'us'),
+                  3: (300,'us'),
+                  4: (1,'ms'),
+                  5: (3,'ms'),
+                  6: (10,'ms'),
+                  7: (30,'ms'),
+                  8: (100,'ms'),
+                  9: (300,'ms'),
+                  10: (1,'s'),
+                  11: (3,'s'),
+                  12: (10,'s'),
+                  13: (30,'s'),
+                  14: (100,'s'),
+                  15: (300,'s'),
+                  16: (1,'ks'),
+                  17: (3,'ks'),
+                  18: (10,'ks'),
+                  19: (30,'ks')}
+
+    _tc_cmd = "OFLT %d"
+    _tc_query = "OFLT?"
+
+    slopes = {0: 6,
+              1: 12,
+              2: 18,
+              3: 24}
+
+    _slope_cmd = "OFSL %d"
+    _slope_query = "OFSL?"
+
     ADC_cmd = "OAUX?%d"
     ADC_range = (1, 2, 3, 4)
     DAC_range = (1, 2, 3, 4)
@@ -53,17 +309,34 @@ class srs830(object):
         'R': 3,
     }
 
-    def measure(self, command):
+    def measure(self, command, unit='V'):
         """
         Measure one of the usual signals (X, Y, or MAG).
         
         Results are given in units of volts or degrees.
 
+        As with :meth:`egg5110.measure`, ``unit`` can be another
+        voltage unit ('mV' etc.), ``None`` for a fraction of
+        the sensitivity, or ``True`` for a (value, unit) tuple.
+        All but the default use the cached sensitivity.
+
         """
-        #TODO: parity with the other lockin re: units
         cmd = 'OUTP?%d' % self.measurements[command]
         response = self.bus.ask(cmd)
-        return float(response)
+        volts = float(response)
+        if unit == 'V':
+            return volts
+        elif unit is None:
+            fraction = volts / self.get_sensitivity()
+            if abs(fraction) > 1:
+                # overloaded: re-read the sensitivity next time
+                self._sens_code = None
+            return fraction
+        elif unit in self._V_scales.keys():
+            return volts / self._V_scales[unit]
+        else:
+            sens,unit = self.get_sensitivity(unit=True)
+            return volts / self._V_scales[unit], unit
 
     def get_x(self):
         return self.measure('X')
@@ -77,6 +350,60 @@ class srs830(object):
         return self.measure('MAG')
     r = property(get_r)
 
+    snap_params = {
+        'X': 1,
+        'Y': 2,
+        'R': 3,
+        'MAG': 3,
+        'THETA': 4,
+        'PHASE': 4,
+        'AUX1': 5,
+        'AUX2': 6,
+        'AUX3': 7,
+        'AUX4': 8,
+        'FREQ': 9,
+        'CH1': 10,
+        'CH2': 11,
+    }
+
+    def snapshot(self, *params):
+        """
+        Measure several parameters at the same instant.
+
+        Uses a single ``SNAP?`` query, so the values are
+        simultaneous, and only cost one bus round trip.
+
+        :param params: two to six different names from :attr:`snap_params`
+                       (X, Y, R, THETA, AUX1-4, FREQ, CH1, CH2).
+                       Default: X, Y, R and THETA.
+        :returns: a numpy record, with a field for each parameter.
+
+        >>> rec = li.snapshot('X', 'Y', 'AUX1')
+        >>> rec['X'], rec['AUX1']
+        (0.0014, 2.5)
+
+        Records of the same parameters stack into a structured array:
+
+        >>> log = numpy.array([li.snapshot() for i in range(10)])
+        >>> log['R'].mean()
+
+        """
+        if not params:
+            params = ('X', 'Y', 'R', 'THETA')
+        if not 2 <= len(params) <= 6:
+            raise InstrumentError("Snapshot takes 2 to 6 parameters")
+        for p in params:
+            if p not in self.snap_params:
+                err = "Snapshot parameters are %s" % sorted(self.snap_params)
+                raise InstrumentError(err)
+        if len(set(params)) != len(params):
+            raise InstrumentError("Snapshot parameters must be different")
+        cmd = "SNAP?" + ",".join(str(self.snap_params[p]) for p in params)
+        response = self.bus.ask(cmd)
+        values = tuple(float(v) for v in response.strip().split(','))
+        record = numpy.array(values, dtype=[(p, float) for p in params])
+        return record[()]
+
     def get_ADC(self,n):
         """ read one of the ADC ports. Return value in volts."""
         if n not in self.ADC_range:
@@ -103,8 +430,168 @@ class srs830(object):
             raise InstrumentError(err)
         response = self.bus.write("AUXV %d, %.3f" % (n, value))
 
+    # data buffer functions
+
+    sample_rates = {0: 0.0625,
+                    1: 0.125,
+                    2: 0.25,
+                    3: 0.5,
+                    4: 1,
+                    5: 2,
+                    6: 4,
+                    7: 8,
+                    8: 16,
+                    9: 32,
+                    10: 64,
+                    11: 128,
+                    12: 256,
+                    13: 512,
+                    14: 'trigger'}
+
+    # what each channel display (and so its buffer) can show
+    displays = {1: {'X': 0, 'R': 1, 'XNOISE': 2, 'AUX1': 3, 'AUX2': 4},
+                2: {'Y': 0, 'THETA': 1, 'YNOISE': 2, 'AUX3': 3, 'AUX4': 4}}
+
+    buffer_size = 16383
+
+    def get_sample_rate(self):
+        """ Get the buffer sample rate, in Hz (or 'trigger'). """
+        val = self.bus.ask("SRAT?")
+        return self.sample_rates[int(val)]
+    def set_sample_rate(self, rate):
+        """ Set the buffer sample rate, in Hz (or 'trigger'). """
+        codes = dict((v, k) for k, v in self.sample_rates.items())
+        if rate not in codes:
+            err = "Sample rate must be one of %s" % sorted(codes)
+            raise InstrumentError(err)
+        self.bus.write("SRAT %d" % codes[rate])
+    sample_rate = property(get_sample_rate, set_sample_rate)
+    """ Buffer sample rate in Hz, or 'trigger' for external triggering. """
+
+    def configure_buffer(self, rate, ch1='X', ch2='Y', loop=False):
+        """
+        Set up the data buffer for an acquisition.
+
+        :param rate: sample rate in Hz, one of :attr:`sample_rates`
+                     (62.5 mHz to 512 Hz), or 'trigger' to take a
+                     point on each trigger input.
+        :param ch1: what channel 1 stores: X, R, XNOISE, AUX1 or AUX2.
+        :param ch2: what channel 2 stores: Y, THETA, YNOISE, AUX3 or AUX4.
+        :param loop: when the buffer fills, keep going and overwrite
+                     the oldest points, rather than stopping.
+
+        The buffers record whatever the front panel displays show,
+        so this changes the displays too. Clears the buffer.
 
-class egg5110(object):
+        """
+        for n, display in ((1, ch1), (2, ch2)):
+            if display not in self.displays[n]:
+                err = "Channel %d can show %s" % (n, sorted(self.displays[n]))
+                raise InstrumentError(err)
+            self.bus.write("DDEF %d,%d,0" % (n, self.displays[n][display]))
+        self.set_sample_rate(rate)
+        self.bus.write("SEND %d" % bool(loop))
+        self.reset_buffer()
+
+    def start_buffer(self):
+        """ Start (or resume) filling the data buffer. """
+        self.bus.write("STRT")
+
+    def pause_buffer(self):
+        """ Pause the data buffer. """
+        self.bus.write("PAUS")
+
+    def reset_buffer(self):
+        """ Clear the data buffer. Pauses it if running. """
+        self.bus.write("REST")
+
+    def get_buffered_points(self):
+        """ Get the number of points stored in the buffer. """
+        return int(self.bus.ask("SPTS?"))
+    buffered_points = property(get_buffered_points)
+    """ Number of points stored in the buffer. """
+
+    def get_buffer(self, channel=1, start=0, count=None,
+                   binary=True, chunk=4096):
+        """
+        Download points from one channel of the data buffer.
+
+        :param channel: 1 or 2.
+        :param start: index of the first point to read.
+        :param count: number of points. Default: all stored points
+                      after ``start``.
+        :param binary: transfer IEEE floats (``TRCB?``), rather than
+                       text (``TRCA?``). Binary is several times
+                       faster, but needs a bus that doesn't stop
+                       reading at newline bytes (e.g. EOI-terminated
+                       GPIB reads).
+        :param chunk: maximum points per query.
+        :returns: numpy array of the buffered values (volts, degrees...).
+
+        """
+        if channel not in (1, 2):
+            raise InstrumentError("Indicate channel 1 or 2")
+        if count is None:
+            count = self.get_buffered_points() - start
+        if count <= 0:
+            return numpy.zeros(0)
+        pieces = []
+        for first in range(start, start + count, chunk):
+            n = min(chunk, start + count - first)
+            if binary:
+                pieces.append(self._read_binary(channel, first, n))
+            else:
+                response = self.bus.ask("TRCA? %d,%d,%d" % (channel, first, n))
+                pieces.append(numpy.array(response.strip(',\r\n').split(','),
+                                          dtype=float))
+        return numpy.concatenate(pieces)
+
+    def _read_binary(self, channel, first, n):
+        """ n points from the buffer, as 4-byte IEEE floats. """
+        self.bus.write("TRCB? %d,%d,%d" % (channel, first, n))
+        expected = 4 * n
+        data = ''
+        while len(data) < expected:
+            received = self.bus.read()
+            if not received:
+                err = "Buffer transfer ended after %d of %d bytes" % \
+                      (len(data), expected)
+                raise InstrumentError(err)
+            data += received
+        return numpy.fromstring(data[:expected], dtype='<f4').astype(float)
+
+    def acquire(self, duration, rate=512, ch1='X', ch2='Y', **kwargs):
+        """
+        Take a hardware-timed trace using the data buffer.
+
+        Configures the buffer, fills it for ``duration`` seconds,
+        and downloads both channels.
+
+        :returns: three numpy arrays: time (in seconds, from the
+                  start of the acquisition) and the two channels.
+
+        >>> t, x, y = li.acquire(2., rate=512)
+
+        Keyword arguments are passed to :meth:`get_buffer`.
+
+        """
+        if rate == 'trigger':
+            raise InstrumentError("acquire needs a sample rate in Hz")
+        if duration * rate > self.buffer_size:
+            err = "%g s at %g Hz won't fit in the buffer" % (duration, rate)
+            raise InstrumentError(err)
+        self.configure_buffer(rate, ch1, ch2)
+        self.start_buffer()
+        sleep(duration)
+        self.pause_buffer()
+        count = self.get_buffered_points()
+        one = self.get_buffer(1, count=count, **kwargs)
+        two = self.get_buffer(2, count=count, **kwargs)
+        t = numpy.arange(count) / float(rate)
+        return t, one, two
+
+
+class egg5110(_lockin):
     """ An EG&G model 5110 lock-in.
 
     Typically controlled over GPIB, address 12. Instantiate like:
@@ -114,6 +601,13 @@ class egg5110(object):
     where ``plx`` is a prologix controller.
     pyVISA instruments should also work fine.
 
+    The sensitivity is cached, so that measurements in volts
+    cost a single query. Sensitivity changes made through this
+    object keep the cache up to date, but changes made on the front
+    panel are only noticed when the cache is revalidated: after an
+    overloaded reading, after ``sensitivity_ttl`` seconds (if set),
+    or when calling ``get_sensitivity(refresh=True)``.
+
     """
     def __init__(self, bus):
         self.bus = bus
@@ -148,44 +642,8 @@ class egg5110(object):
                      20: (500,'mV'), \
                      21: (1,'V')}
 
-    _V_scales = {'V': 1.,
-                'mV': 1e-3,
-                'uV': 1e-6,
-                'nV': 1e-9}
-    
-    def get_sensitivity(self, unit='V'):
-        """
-        Get the current sensitivity, in Volts.
-
-        >>> li.get_sensitivity()
-        0.1
-
-        If the `unit` kwarg is specified, the value will
-        be converted to the desired unit instead.
-
-        >>> li.get_sensitivity(unit='uV')
-        100000.
-
-        Using `unit=True` will return a value in a 2-tuple
-        along with the most sensible unit (as a string).
-
-        >>> li.get_sensitivity(unit=True)
-        (100, 'mV')
-
-        """
-        val = self.bus.ask("SEN")
-        q,u = self.sensitivities[int(val)]
-        if unit in self._V_scales.keys():
-            sens = q * self._V_scales[u] / self._V_scales[unit]
-            return sciround(sens, 1)
-        else:
-            return q,u
-    def set_sensitivity(self,code):
-        """Set the current sensitivity (Using a code)."""
-        self.bus.write("SEN %d" % code)
-    sensitivity = property(get_sensitivity,set_sensitivity)
-    """ Current value of the sensitivity, in volts. """
-    #TODO: set with a value in volts
+    _sens_cmd = "SEN %d"
+    _sens_query = "SEN"
 
     # time constant functions
 
@@ -203,18 +661,14 @@ class egg5110(object):
                   11: (100,'s'), \
                   12: (300,'s')}
 
-    def get_timeconst(self):
-        """Get the current time constant (as a 2-tuple)."""
-        val = self.bus.ask("TC")
-        return self.timeconsts[int(val)]
-    def set_timeconst(self,code):
-        """Set the current time constant (Using a code)."""
-        self.bus.write("TC %d" % code)
-    timeconst = property(get_timeconst,set_timeconst)
-    """
-    Current value of the time constant as a 2-tuple.
+    _tc_cmd = "TC %d"
+    _tc_query = "TC"
 
-    """
+    slopes = {0: 6, \
+              1: 12}
+
+    _slope_cmd = "XDB %d"
+    _slope_query = "XDB"
 
     # measurement functions
 
@@ -252,17 +706,21 @@ class egg5110(object):
 
         .. note ::
             to provide an answer in real units, the EG&G
-            5110 needs to be queried for its sensitivity
-            on every single measurement. This can slow
-            things down. If you need to make measurements
-            quickly, and are using a fixed sensitivity,
-            specify ``unit=None`` for speed.
+            5110 needs to know its sensitivity. This is
+            cached (see :class:`egg5110`), so it isn't
+            queried on every measurement, but a change made
+            on the front panel won't be noticed until the
+            next overload or ``sensitivity_ttl`` expiry.
 
         """
         response = self.bus.ask(command)
         # the 5110 lockin returns measurements
         # as ten-thousandths of full-scale
         fraction = int(response) / 10000.
+        if abs(fraction) > 1:
+            # overloaded. Maybe the sensitivity has
+            # been changed behind our back: re-read it.
+            self._sens_code = None
         if unit is None:
             return fraction 
         elif unit in self._V_scales.keys():
@@ -328,3 +786,114 @@ class egg5110(object):
         cmd = "LTS %d" % bool(arg)
         self.bus.write(cmd)
 
+
+class autoranger(object):
+    """
+    Measure with a lock-in, adjusting its sensitivity as needed.
+
+    :param lockin: an :class:`egg5110` or :class:`srs830`.
+    :param command: signal to measure (X, Y, or MAG).
+    :param lower: readings below this fraction of full scale switch
+                  to a more sensitive range.
+    :param upper: readings above this fraction of full scale (or
+                  overloads) switch to a less sensitive range.
+    :param target: fraction of full scale to aim for when switching.
+                   Ranges go up in steps of at most 2.5x, so with
+                   ``lower < target / 2.5 < target < upper``, a new
+                   range never needs changing again straight away.
+    :param floor: readings below this fraction of full scale are
+                  taken to be this big when picking a new range, as
+                  they are mostly noise (or, on the EG&G 5110,
+                  rounded to the nearest 1e-4 of full scale).
+    :param settle: time constants to wait after each range change.
+                   Default: as long as the lock-in's
+                   :meth:`~_lockin.settle_time`.
+    :param tries: maximum range changes per point.
+
+    Calling the autoranger returns a measurement in volts, so it can
+    be used as the ``get`` function of :func:`wanglib.util.scanner`:
+
+    >>> ar = autoranger(li, 'X')
+    >>> gen = scanner(wls, set=tr.set_wl, get=ar)
+    >>> wl, x = plotgen(gen)
+    >>> ar.ranges # the sensitivity used for each point, in volts
+
+    Readings between ``lower`` and ``upper`` leave the range alone,
+    so noise near a range boundary doesn't cause flip-flopping.
+    When a change is needed, the autoranger goes straight to the
+    range that puts the reading at ``target``, rather than stepping
+    through every range in between, waiting each time. Only very
+    small readings and overloads (when the true value is unknown)
+    take more than one change: an overload first goes up a decade,
+    and if still overloaded, to the least sensitive range.
+
+    Attributes:
+        ranges -- sensitivity (in volts) used for each point
+        changes -- number of range changes (and waits) so far
+
+    """
+    def __init__(self, lockin, command='X', lower=0.2, upper=0.9,
+                 target=0.7, floor=1e-3, settle=None, tries=5):
+        self.lockin = lockin
+        self.command = command
+        self.lower, self.upper, self.target = lower, upper, target
+        self.floor = floor
+        self.settle = settle
+        self.tries = tries
+        self.ranges = []
+        self.changes = 0
+
+    def choose(self, code, fraction, again=False):
+        """
+        Pick the sensitivity code for a reading.
+
+        :param code: the current sensitivity code.
+        :param fraction: the reading, as a fraction of full scale.
+        :param again: whether the last reading was an overload too.
+        :returns: the code to use (the same one if no change needed).
+
+        """
+        li = self.lockin
+        codes = sorted(li.sensitivities)
+        a = abs(fraction)
+        if a > 1:
+            # overloaded: we don't know by how much.
+            # Go up a decade, or all the way if that wasn't enough.
+            return codes[-1] if again else min(code + 3, codes[-1])
+        if self.lower <= a <= self.upper:
+            return code
+        volts = max(a, self.floor) * li._sensitivity_volts(code)
+        for c in codes:
+            if volts <= self.target * li._sensitivity_volts(c):
+                return c
+        return codes[-1]
+
+    def measure(self):
+        """
+        Measure, re-ranging if needed.
+
+        :returns: the measurement and the sensitivity, both in volts.
+
+        """
+        li = self.lockin
+        overloaded = False
+        for i in range(self.tries + 1):
+            fraction = li.measure(self.command, unit=None)
+            code = li._get_sensitivity_code()
+            new = self.choose(code, fraction, overloaded)
+            overloaded = abs(fraction) > 1
+            if new == code or i == self.tries:
+                break
+            li.set_sensitivity(new)
+            self.changes += 1
+            if self.settle is None:
+                li.wait_settled()
+            else:
+                sleep(self.settle * li._timeconst_seconds())
+        sens = li._sensitivity_volts(code)
+        return fraction * sens, sens
+
+    def __call__(self):
+        value, sens = self.measure()
+        self.ranges.append(sens)
+        return value
@@ -5,8 +5,59 @@ Interfaces to Tektronix oscilloscopes.
 """
 
 from wanglib.util import InstrumentError, sciround
+from time import time
 import numpy
 
+# waveform preamble fields, in the order WFMPRE? returns them
+preamble_fields = (('BYT_NR', int), ('BIT_NR', int),
+                   ('ENCDG', str), ('BN_FMT', str),
+                   ('BYT_OR', str), ('NR_PT', int),
+                   ('WFID', str), ('PT_FMT', str),
+                   ('XINCR', float), ('PT_OFF', int),
+                   ('XZERO', float), ('XUNIT', str),
+                   ('YMULT', float), ('YZERO', float),
+                   ('YOFF', float), ('YUNIT', str))
+
+def parse_preamble(response):
+    """
+    Parse the response to a ``WFMPRE?`` query.
+
+    Items with headers are matched to fields by their header,
+    which may be abbreviated (``XIN`` for ``XINCR``) if the scope
+    isn't in verbose mode. Without headers (``HEAD OFF``), items
+    are taken in the documented order. Fields missing from the
+    response are left out of the result.
+
+    >>> p = parse_preamble(':WFMPRE:BYT_NR 2;BIT_NR 16;ENCDG BIN;'
+    ...     'BN_FMT RI;BYT_OR MSB;NR_PT 10000;WFID "Ch1, DC coupling, '
+    ...     '100.0mV/div, 4.000us/div, 10000 points, Sample mode";'
+    ...     'PT_FMT Y;XINCR 4.0000E-9;PT_OFF 0;XZERO -20.0000E-6;'
+    ...     'XUNIT "s";YMULT 15.6250E-6;YZERO 0.0E+0;YOFF 6.4000E+3;'
+    ...     'YUNIT "V"')
+    >>> p['PT_OFF'], p['XZERO'], p['YOFF'], p['YZERO'], p['XUNIT']
+    (0, -2e-05, 6400.0, 0.0, 's')
+
+    """
+    kinds = dict(preamble_fields)
+    items = [item.strip() for item in response.strip().split(';')]
+    preamble = {}
+    for i, item in enumerate(items):
+        if ' ' in item and not item.startswith('"'):
+            # e.g. ':WFMPRE:BYT_NR 2', or 'XIN 4.0E-9' when terse
+            header, item = item.split(None, 1)
+            header = header.split(':')[-1].upper()
+            keys = [key for key, kind in preamble_fields
+                    if key.startswith(header)]
+            if len(keys) != 1:
+                continue # not a field we know about
+            key = keys[0]
+        elif i < len(preamble_fields):
+            key = preamble_fields[i][0]
+        else:
+            continue
+        preamble[key] = kinds[key](item.strip('"'))
+    return preamble
+
 class TDS3000(object):
     """ A Tektronix oscilloscope from the TDS3000 series.
 
@@ -22,6 +73,14 @@ class TDS3000(object):
     connect using a null modem cable.
     You will probably need to use the highest baud rate you can.
 
+    Fetching a trace takes one ``WFMPRE?`` query, for the whole
+    waveform preamble (scaling and format), plus the curve itself.
+    To skip even that when fetching many traces without touching
+    the front panel, pass ``refresh=False``: the preamble from the
+    last fetch is then reused, until the source, time scale or data
+    format is changed through this object, or ``preamble_ttl``
+    seconds (if set) have gone by.
+
     """
 
     class _parameterset(dict):
@@ -29,9 +88,10 @@ class TDS3000(object):
 
         def __init__(self, bus, prefix='',
                     strs = (), floats = (),
-                     ints = (), bools = ()):
+                     ints = (), bools = (), changed = None):
             self.bus = bus
             self.prefix = prefix
+            self.changed = changed # called after setting anything
             self.strs = strs
             self.floats = floats
             self.ints = ints
@@ -64,6 +124,8 @@ class TDS3000(object):
                 self.bus.write('%s%s %d' % (self.prefix, key, int(value)))
             else:
                 raise NotImplementedError
+            if self.changed is not None:
+                self.changed()
 
     def __init__(self, bus=None):
         if bus is None:
@@ -76,7 +138,8 @@ class TDS3000(object):
         self.wfmpre = self._parameterset(bus, prefix='WFMP:',
             strs = ('ENCDG', 'BN_FMT', 'BYT_OR', 'XUNIT', 'YUNIT'),
             floats = ('XZERO', 'XINCR', 'YOFF', 'YZERO', 'YMULT'),
-            ints = ('BYT_NR', 'BIT_NR', 'NR_PT', 'PT_OFF'))
+            ints = ('BYT_NR', 'BIT_NR', 'NR_PT', 'PT_OFF'),
+            changed = self.clear_preamble)
         self.acquire = self._parameterset(bus, prefix = 'ACQ:',
             strs = ('MODE', 'STOPA'),
             ints = ('NUMAVG', 'NUMENV'),
@@ -117,6 +180,50 @@ class TDS3000(object):
 
     #TODO document wfmpre parameter set
 
+    preamble_ttl = None
+    """ Seconds before the cached preamble is re-read (None: never). """
+
+    _preamble = None      # cached preamble
+    _preamble_time = 0.   # when it was read
+    _source = None        # cached data source
+
+    def get_preamble(self, source=None, refresh=False):
+        """
+        Get the waveform preamble: everything needed to
+        interpret a curve (format, scaling, and units).
+
+        :param source: Channel to describe. Defaults to
+            value of :attr:`data_source`.
+        :param refresh: re-read the preamble, even if cached.
+        :returns: A dictionary, keyed like :attr:`wfmpre`.
+
+        All of it is read with a single ``WFMPRE?`` query. Unless
+        `refresh`, a cached copy is returned if there is one: it is
+        kept until the source, time scale or format is changed
+        through this object, or for ``preamble_ttl`` seconds.
+
+        """
+        if source is not None:
+            self.data_source = source
+        expired = (self.preamble_ttl is not None and
+                   time() - self._preamble_time > self.preamble_ttl)
+        if refresh or expired or self._preamble is None:
+            response = self.bus.ask('WFMP?')
+            self._preamble = self._parse_preamble(response)
+            self._preamble_time = time()
+        return self._preamble
+
+    def _parse_preamble(self, response):
+        preamble = parse_preamble(response)
+        if len(preamble) < len(preamble_fields):
+            # the scope only describes waveforms that are displayed
+            raise InstrumentError('%s not turned on' % self.data_source)
+        return preamble
+
+    def clear_preamble(self):
+        """ Forget the cached preamble, so it is read again. """
+        self._preamble = None
+
     @property
     def data_source(self):
         """
@@ -126,15 +233,23 @@ class TDS3000(object):
         `MATH`, `MATH1` (same as `MATH`), `REF1`, `REF2`, `REF3`,
         and `REF4`.
 
+        Cached, since it only changes through this object.
+
         """
-        result = self.bus.ask('DAT:SOU?')
-        return result.rstrip()
+        if self._source is None:
+            result = self.bus.ask('DAT:SOU?')
+            self._source = result.rstrip().upper()
+        return self._source
 
     @data_source.setter
     def data_source(self, val):
         if type(val) is int:
             val = 'CH%d' % val
+        if val.upper() == self._source:
+            return
         result = self.bus.write('DAT:SOU %s' % val)
+        self._source = val.upper()
+        self.clear_preamble()
 
     def save_wfm(self, source, dest):
         """
@@ -160,7 +275,7 @@ class TDS3000(object):
         """
         return bool(int(self.bus.ask('sel:%s?' % channel)))
 
-    def get_curve(self, source=None):
+    def get_curve(self, source=None, refresh=True):
         """
         Fetch a trace.
 
@@ -168,19 +283,18 @@ class TDS3000(object):
             value of :attr:`data_source`. Valid channels are
             `CH1`, `CH2`, `CH3`, `CH4`, `MATH`, `MATH1` (same as
             `MATH`), `REF1`, `REF2`, `REF3`, or `REF4`.
+        :param refresh: read the preamble afresh. If False, reuse
+            the cached one (see :meth:`get_preamble`).
         :returns: A numpy array representing the current waveform.
 
         """
-        if source is None:
-            source = self.data_source
-        else:
-            self.data_source = source
-        if not self.is_active(source):
-            raise InstrumentError('%s not turned on' % source)
+        return self._read_curve(self.get_preamble(source, refresh))
 
-        fmt = '>' if self.wfmpre['BYT_OR'] == 'MSB' else '<'
-        fmt += 'i' if self.wfmpre['BN_FMT'] == 'RI' else 'u'
-        fmt += str(self.wfmpre['BYT_NR'])
+    def _read_curve(self, preamble):
+        """ read the curve, in the format given by the preamble """
+        fmt = '>' if preamble['BYT_OR'] == 'MSB' else '<'
+        fmt += 'i' if preamble['BN_FMT'] == 'RI' else 'u'
+        fmt += str(preamble['BYT_NR'])
 
         self.bus.write('CURV?')
         result = self.bus.read() # reads either everything (GPIB)
@@ -196,7 +310,7 @@ class TDS3000(object):
 
         return numpy.fromstring(result, dtype = fmt)
 
-    def get_wfm(self, source=None):
+    def get_wfm(self, source=None, refresh=True):
         """
         Fetch a trace, scaled to actual units.
 
@@ -204,14 +318,17 @@ class TDS3000(object):
             value of :attr:`data_source`. Valid channels are
             `CH1`, `CH2`, `CH3`, `CH4`, `MATH`, `MATH1` (same as
             `MATH`), `REF1`, `REF2`, `REF3`, or `REF4`.
+        :param refresh: read the preamble afresh. If False, reuse
+            the cached one, which is only safe if the scales haven't
+            been changed on the front panel since.
         :returns: Two numpy arrays: `t` and `y`
 
         """
-        curv = self.get_curve(source).astype(float)
-        y = ((curv - self.wfmpre['YOFF'])
-             * self.wfmpre['YMULT']) + self.wfmpre['YZERO']
-        t = (numpy.arange(self.wfmpre['NR_PT'], dtype=float)
-             * self.wfmpre['XINCR']) + self.wfmpre['XZERO']
+        pre = self.get_preamble(source, refresh)
+        curv = self._read_curve(pre).astype(float)
+        y = ((curv - pre['YOFF']) * pre['YMULT']) + pre['YZERO']
+        t = (numpy.arange(len(curv), dtype=float)
+             * pre['XINCR']) + pre['XZERO']
         return t, y
 
     def get_timediv(self):
@@ -247,6 +364,7 @@ class TDS3000(object):
         to = sciround(to, 1)
         if to in self._acceptable_timedivs:
             self.bus.write('HOR:MAI:SCA %.0E' % to)
+            self.clear_preamble()
         else:
             raise InstrumentError('Timediv not in %s' %
                                   str(self._acceptable_timedivs))
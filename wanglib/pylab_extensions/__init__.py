@@ -6,7 +6,9 @@ This module contains some useful extensions to the pylab interface.
 """
 
 from live_plot import plotgen
-from density import density_plot
+from density import density_plot, live_density
 from misc import cll, sll, bll, gll
+from misc import sal, gal, load_lines
 from misc import apply_mask, apply_offset, apply_reference
+from misc import apply_masks, apply_offsets, apply_references
 from misc import dualtick
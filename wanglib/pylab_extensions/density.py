@@ -1,6 +1,6 @@
-from pylab import gca
-import matplotlib as mpl
+import numpy
 from numpy import asarray
+from time import time
 
 def density_plot(two_dimensional, horiz, vert,
                  ax=None, **kwargs):
@@ -8,22 +8,29 @@ def density_plot(two_dimensional, horiz, vert,
     Display a 2D density plot - like imshow, but with
     axes labels corresponding to the two axes provided.
 
-    This will only be accurate for regularly-spaced
-    x and y axes (e.g., as generated by arange or linspace).
+    For regularly-spaced x and y axes (e.g., as generated by
+    arange or linspace), this uses imshow. Otherwise (log-spaced
+    or adaptive scans, say), it uses pcolormesh, so each pixel
+    is drawn where it was measured, without first resampling the
+    data onto a regular grid.
 
     :param two_dimensional: data to plot. shape: (M, N)
     :param horiz: x-axis. should have length N.
     :param vert: y-axis. should have length M.
     :param ax: axis upon which to plot.
 
-    Keyword arguments are passed to imshow.
+    Keyword arguments are passed to imshow (or pcolormesh).
 
     """
+    import matplotlib as mpl
     if ax is None:
+        from pylab import gca
         ax = gca()
     two_dimensional = asarray(two_dimensional)
     horiz, vert = asarray(horiz), asarray(vert)
     assert two_dimensional.shape == vert.shape + horiz.shape
+    if not (_regular(horiz) and _regular(vert)):
+        return _mesh_plot(two_dimensional, horiz, vert, ax, **kwargs)
     horiz_spacing = (horiz[-1] - horiz[0]) / (len(horiz) - 1.)
     vert_spacing = (vert[-1] - vert[0]) / (len(vert) - 1.)
     # add spacing to the upper bounds. This aligns tick
@@ -45,3 +52,146 @@ def density_plot(two_dimensional, horiz, vert,
         # the first step alone gets us back to a square image aspect.
         # the second will restore the native aspect ratio of the array.
     return ax.imshow(two_dimensional, extent=ext, aspect=aspect, **kwargs)
+
+def _regular(axis, rtol=1e-3):
+    """ True if the axis values are evenly spaced. """
+    if len(axis) < 3:
+        return True
+    steps = numpy.diff(axis)
+    return numpy.allclose(steps, steps.mean(), rtol=rtol, atol=0)
+
+def _edges(axis):
+    """
+    Pixel edges for an axis, with each value at the lower edge
+    of its pixel (as in the imshow case), and the last pixel as
+    wide as the one before it.
+
+    """
+    if len(axis) < 2:
+        return numpy.r_[axis, axis + 1.]
+    return numpy.r_[axis, 2 * axis[-1] - axis[-2]]
+
+_mesh_cache = {} # the last mesh computed, keyed by its axes
+
+def _mesh(horiz, vert):
+    """ pcolormesh corner coordinates for the two axes (cached). """
+    key = (horiz.tostring(), vert.tostring())
+    if key not in _mesh_cache:
+        _mesh_cache.clear()
+        _mesh_cache[key] = numpy.meshgrid(_edges(horiz), _edges(vert))
+    return _mesh_cache[key]
+
+def _mesh_plot(two_dimensional, horiz, vert, ax, **kwargs):
+    """ density_plot for irregularly-spaced axes. """
+    import matplotlib as mpl
+    # these are imshow-only
+    origin = kwargs.pop('origin', mpl.rcParams['image.origin'])
+    kwargs.pop('interpolation', None)
+    aspect = kwargs.pop('aspect', None)
+    X, Y = _mesh(horiz, vert)
+    data = numpy.ma.masked_invalid(two_dimensional)
+    mesh = ax.pcolormesh(X, Y, data, **kwargs)
+    if aspect is not None:
+        ax.set_aspect(aspect)
+    # imshow puts the first row at the top, by default
+    if origin == 'upper' and not ax.yaxis_inverted():
+        ax.invert_yaxis()
+    return mesh
+
+class live_density(object):
+    """
+    A density plot of a 2D scan, filled in as the data come in.
+
+    :param horiz: x-axis. should have length N.
+    :param vert: y-axis. should have length M.
+    :param ax: axis upon which to plot.
+
+    Keyword arguments are passed to :func:`density_plot`.
+    Irregularly-spaced axes are fine: the mesh is built once,
+    and only its colors are updated.
+
+    The image data live in a preallocated (M, N) array, :attr:`data`,
+    which starts out filled with NaN (drawn blank). Rows and pixels
+    are filled in place, so nothing is reallocated as the scan goes
+    on; the image itself is only updated when the figure is redrawn.
+    Color limits are left alone until :meth:`rescale` is called.
+
+    >>> ld = live_density(xs, ys)
+    >>> for i, y in enumerate(ys):
+    ...     ld.set_row(i, measure_row(y))
+    ...     ld.rescale()
+
+    To plot straight from a generator, use :meth:`plotgen`.
+
+    """
+    def __init__(self, horiz, vert, ax=None, **kwargs):
+        self.data = numpy.empty((len(vert), len(horiz)))
+        self.data.fill(numpy.nan)
+        # nothing to autoscale to yet
+        kwargs.setdefault('vmin', 0.)
+        kwargs.setdefault('vmax', 1.)
+        self.image = density_plot(self.data, horiz, vert, ax=ax, **kwargs)
+
+    def set_row(self, i, values, draw=True):
+        """ fill in row ``i`` of the image. """
+        self.data[i] = values
+        if draw:
+            self.draw()
+
+    def set_pixel(self, i, j, value, draw=True):
+        """ fill in column ``j`` of row ``i``. """
+        self.data[i, j] = value
+        if draw:
+            self.draw()
+
+    def draw(self):
+        """ redraw the figure, with the data so far. """
+        # the image keeps its own copy of the data, so
+        # only hand it over when it is about to be drawn
+        if hasattr(self.image, 'set_data'):
+            self.image.set_data(self.data)
+        else:
+            # irregular axes: the image is a pcolormesh
+            self.image.set_array(numpy.ma.masked_invalid(self.data).ravel())
+        self.image.figure.canvas.draw()
+
+    def rescale(self, draw=True):
+        """ set the color limits to the range of the data so far. """
+        finite = self.data[numpy.isfinite(self.data)]
+        if len(finite):
+            self.image.set_clim(finite.min(), finite.max())
+        if draw:
+            self.draw()
+
+    def plotgen(self, gen, fps=10.):
+        """
+        Fill in the image from a generator, plotting as it goes.
+
+        :param gen: a generator yielding either ``(i, row)`` pairs,
+                    to fill in whole rows, or ``(i, j, value)``
+                    triples, to fill in single pixels.
+                    :func:`wanglib.util.scanner2d` makes the latter.
+        :param fps: maximum redraws per second.
+        :returns: the image data.
+
+        Color limits are recomputed each time a row is finished.
+
+        """
+        interval = 1. / fps
+        last = time()
+        for item in gen:
+            if len(item) == 2:
+                i, row = item
+                self.set_row(i, row, draw=False)
+                finished = True
+            else:
+                i, j, value = item
+                self.set_pixel(i, j, value, draw=False)
+                finished = (j == self.data.shape[1] - 1)
+            if finished:
+                self.rescale(draw=False)
+            if time() - last >= interval:
+                self.draw()
+                last = time()
+        self.rescale()
+        return self.data
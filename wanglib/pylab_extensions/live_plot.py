@@ -5,17 +5,435 @@ This module facilitates plotting of data while it is being gathered.
 
 """
 
-from pylab import plot, gca, draw
-from collections import deque
-import itertools
+from time import time
+import numpy
 
-def plotgen(gen, ax=None, maxlen=None, **kwargs):
+class _ringbuffer(object):
+    """
+    The most recent values of a growing series, in a numpy array.
+
+    :attr:`view` is a contiguous slice of the underlying array, so
+    it can be handed to a line without any conversion. Appending is
+    amortized O(1): without a ``maxlen``, the array doubles in size
+    when it fills up; with one, the array holds ``2 * maxlen`` values,
+    and the last ``maxlen`` are moved back to the front when it fills.
+
+    """
+    def __init__(self, maxlen=None, capacity=1024):
+        self.maxlen = maxlen
+        if maxlen is not None:
+            capacity = 2 * maxlen
+        self.data = numpy.empty(capacity)
+        self.start = self.stop = 0
+        self.count = 0 # total number of values ever appended
+
+    def __len__(self):
+        return self.stop - self.start
+
+    @property
+    def view(self):
+        return self.data[self.start:self.stop]
+
+    def _make_room(self, n):
+        """ ensure there is room to append n values """
+        if self.stop + n <= len(self.data):
+            return
+        if self.maxlen is None:
+            capacity = len(self.data)
+            while capacity < self.stop + n:
+                capacity *= 2
+            data = numpy.empty(capacity)
+            data[:self.stop] = self.data[:self.stop]
+            self.data = data
+        else:
+            keep = min(self.stop - self.start, self.maxlen - n)
+            self.data[:keep] = self.data[self.stop - keep:self.stop]
+            self.start, self.stop = 0, keep
+
+    def append(self, value):
+        self._make_room(1)
+        self.data[self.stop] = value
+        self.stop += 1
+        self.count += 1
+        if self.maxlen is not None and self.stop - self.start > self.maxlen:
+            self.start += 1
+
+    def extend(self, values):
+        values = numpy.asarray(values, dtype=float)
+        if self.maxlen is not None:
+            values = values[-self.maxlen:]
+        n = len(values)
+        self._make_room(n)
+        self.data[self.stop:self.stop + n] = values
+        self.stop += n
+        self.count += n
+        if self.maxlen is not None:
+            self.start = max(self.start, self.stop - self.maxlen)
+
+def _envelope(x, y, x0, x1, columns):
+    """
+    Min and max of y in each of ``columns`` equal bins of x,
+    between x0 and x1.
+
+    Returns arrays ``(column, ilo, ihi)`` for each non-empty
+    column, giving the column number and the indices of the
+    points at which the minimum and maximum occur.
+
+    """
+    keep = numpy.flatnonzero((x >= x0) & (x <= x1) & numpy.isfinite(y))
+    x, y = x[keep], y[keep]
+    if not len(x):
+        return (numpy.zeros(0, dtype=int),) * 3
+    scale = columns / float(x1 - x0) if x1 > x0 else 0.
+    column = ((x - x0) * scale).astype(int)
+    numpy.clip(column, 0, columns - 1, out=column)
+    # sort by column, then by y within each column
+    order = numpy.lexsort((y, column))
+    column = column[order]
+    first = numpy.flatnonzero(numpy.r_[True, column[1:] != column[:-1]])
+    last = numpy.r_[first[1:] - 1, len(column) - 1]
+    return column[first], keep[order[first]], keep[order[last]]
+
+class _decimator(object):
+    """
+    Keeps a line fed with a min/max envelope of its data.
+
+    An x range is split into ``2 * columns`` bins (about two per
+    pixel across the view), and the line gets just the lowest and
+    highest point in each, so it never has more than ``4 * columns``
+    vertices however long the data get. The full data stay in the
+    buffers.
+
+    The envelope is kept up to date incrementally. New points are
+    merged into their bins, and when the data (or the view) outgrow
+    the binned range, the range doubles in width and the existing
+    envelope is merged into the coarser bins, which is exact because
+    each new bin holds two old ones. Nothing is recomputed from the
+    full data unless the view is zoomed in well inside the binned
+    range, or zoomed out past data that weren't binned. Each envelope
+    point remembers its place in the buffers, so when points are
+    trimmed off (with ``maxlen``), they leave the line at once, and
+    only the bins they were in are rebinned.
+
+    With ``columns=None``, the line just gets all the data.
+
+    """
+    def __init__(self, line, x, y, columns=None):
+        self.line = line
+        self.x = x
+        self.y = y
+        self.columns = columns
+        self.xlim = None
+        self._extent = None
+        self._at = None # point numbers of the min and max x
+        self._seen = 0  # x.count when the extent was last updated
+        line.decimator = self
+        if columns is not None:
+            self.bins = 2 * columns
+            line.axes.callbacks.connect('xlim_changed', self.on_zoom)
+
+    @property
+    def data(self):
+        """ the full-resolution data """
+        return self.x.view, self.y.view
+
+    def on_zoom(self, axis):
+        self.update()
+
+    def extent(self):
+        """
+        (min, max) of the x data. Kept up to date incrementally:
+        only recomputed from all the data when the min or max has
+        been trimmed off (with ``maxlen``).
+
+        """
+        x = self.x.view
+        first = self.x.count - len(x)
+        if self._extent is None or min(self._at) < first:
+            self._extent = None
+            start = first
+        else:
+            start = max(self._seen, first)
+        new = x[start - first:]
+        self._seen = self.x.count
+        if len(new) and not numpy.isnan(new).all():
+            i, j = numpy.nanargmin(new), numpy.nanargmax(new)
+            if self._extent is None:
+                self._extent = (new[i], new[j])
+                self._at = (start + i, start + j)
+            else:
+                (x0, x1), (n0, n1) = self._extent, self._at
+                if new[i] < x0:
+                    x0, n0 = new[i], start + i
+                if new[j] > x1:
+                    x1, n1 = new[j], start + j
+                self._extent, self._at = (x0, x1), (n0, n1)
+        if self._extent is None:
+            return numpy.nan, numpy.nan
+        return self._extent
+
+    def _clear(self, xlim):
+        """ start a new, empty envelope over xlim """
+        x0, x1 = xlim
+        if not x1 > x0:
+            x1 = x0 + (abs(x0) or 1.)
+        self.xlim = (x0, x1)
+        # rows are x, y, and the number of the point (as x.count)
+        self.lo = numpy.empty((3, self.bins))
+        self.hi = numpy.empty((3, self.bins))
+        self.lo.fill(numpy.nan)
+        self.hi.fill(numpy.nan)
+
+    def _reset(self, xlim):
+        """ recompute the envelope over xlim from the full data """
+        x, y = self.data
+        self._clear(xlim)
+        self._merge(x, y, numpy.arange(self.x.count - len(x), self.x.count))
+        self.done = self.x.count
+        with numpy.errstate(invalid='ignore'):
+            # whether every point is in the binned range
+            self.complete = not (x < self.xlim[0]).any() and \
+                            not (x > self.xlim[1]).any()
+
+    def _merge(self, x, y, number):
+        """ merge some points, numbered like x.count, into the envelope """
+        column, ilo, ihi = _envelope(x, y, self.xlim[0],
+                                     self.xlim[1], self.bins)
+        with numpy.errstate(invalid='ignore'):
+            # (these are also true where the column was empty)
+            lower = ~(self.lo[1, column] <= y[ilo])
+            higher = ~(self.hi[1, column] >= y[ihi])
+        ilo, ihi = ilo[lower], ihi[higher]
+        self.lo[:, column[lower]] = x[ilo], y[ilo], number[ilo]
+        self.hi[:, column[higher]] = x[ihi], y[ihi], number[ihi]
+
+    def _drop_trimmed(self, x, y, first):
+        """
+        Take points trimmed off the buffers (with ``maxlen``) out of
+        the envelope, and rebin what is left of their columns.
+
+        """
+        with numpy.errstate(invalid='ignore'):
+            stale = (self.lo[2] < first) | (self.hi[2] < first)
+        if not stale.any():
+            return
+        self.lo[:, stale] = numpy.nan
+        self.hi[:, stale] = numpy.nan
+        x0, x1 = self.xlim
+        with numpy.errstate(invalid='ignore'):
+            redo = numpy.flatnonzero((x >= x0) & (x <= x1))
+        column = ((x[redo] - x0) * (self.bins / (x1 - x0))).astype(int)
+        numpy.clip(column, 0, self.bins - 1, out=column)
+        redo = redo[stale[column]]
+        self._merge(x[redo], y[redo], first + redo)
+
+    def _numbers(self, new):
+        """ point numbers of a slice (to the end) of the buffers """
+        return numpy.arange(self.x.count - len(self.x) + new.start,
+                            self.x.count)
+
+    def _expand(self, lo, hi):
+        """ double the binned range until it covers lo to hi """
+        x0, x1 = self.xlim
+        while lo < x0 or hi > x1:
+            if hi > x1:
+                x1 += x1 - x0
+            else:
+                x0 -= x1 - x0
+        if (x0, x1) == self.xlim:
+            return
+        points = numpy.hstack((self.lo[:, numpy.isfinite(self.lo[1])],
+                               self.hi[:, numpy.isfinite(self.hi[1])]))
+        self._clear((x0, x1))
+        self._merge(points[0], points[1], points[2])
+
+    def update(self, xlim=None):
+        """
+        Update the line, to show the data over ``xlim``.
+        By default, the current x limits of the axes.
+
+        """
+        x, y = self.data
+        if self.columns is None or len(x) <= 2 * self.columns:
+            self.xlim = None
+            return self.line.set_data(x, y)
+        if xlim is None:
+            xlim = self.line.axes.get_xlim()
+        lo, hi = sorted(xlim)
+        first = self.x.count - len(x)
+        new = slice(max(self.done - first, 0) if self.xlim else 0, None)
+        with numpy.errstate(invalid='ignore'):
+            if self.xlim is not None and self.complete:
+                # the new points should be binned too
+                lo = min(lo, numpy.nanmin(x[new])) if len(x[new]) else lo
+                hi = max(hi, numpy.nanmax(x[new])) if len(x[new]) else hi
+
+        if self.xlim is None:
+            self._reset((lo, hi))
+        elif lo < self.xlim[0] or hi > self.xlim[1]:
+            if self.complete:
+                self._expand(lo, hi)
+                self._merge(x[new], y[new], self._numbers(new))
+                self.done = self.x.count
+            else:
+                # zoomed out past points we haven't binned
+                self._reset((lo, hi))
+        elif hi - lo < (self.xlim[1] - self.xlim[0]) / 4.:
+            # zoomed in: bin more finely
+            self._reset((lo, hi))
+        else:
+            self._merge(x[new], y[new], self._numbers(new))
+            self.done = self.x.count
+
+        self._drop_trimmed(x, y, first)
+
+        # two points per column, in order of x
+        filled = numpy.isfinite(self.lo[1])
+        lo, hi = self.lo[:, filled], self.hi[:, filled]
+        swap = lo[0] > hi[0]
+        first = numpy.where(swap, hi, lo)
+        second = numpy.where(swap, lo, hi)
+        self.line.set_data(numpy.column_stack((first[0], second[0])).ravel(),
+                           numpy.column_stack((first[1], second[1])).ravel())
+
+class _blitter(object):
+    """
+    Redraws a set of lines over cached copies of their axes
+    backgrounds, without re-rendering anything else.
+
+    The lines are made 'animated', so that full redraws of the
+    figure leave them out of the background. Every full redraw
+    (resize, rescale) recaptures the backgrounds.
+
+    """
+    def __init__(self, lines):
+        self.lines = lines
+        self.axes = []
+        for line in lines:
+            line.set_animated(True)
+            if line.axes not in self.axes:
+                self.axes.append(line.axes)
+        self.canvas = lines[0].figure.canvas
+        self.backgrounds = None
+        self.cid = self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.canvas.draw()
+
+    def on_draw(self, event):
+        self.backgrounds = [self.canvas.copy_from_bbox(axis.bbox)
+                            for axis in self.axes]
+        for line in self.lines:
+            line.axes.draw_artist(line)
+
+    def redraw(self):
+        """ blit the lines. """
+        if self.backgrounds is None:
+            return self.canvas.draw()
+        for axis, background in zip(self.axes, self.backgrounds):
+            self.canvas.restore_region(background)
+            for line in self.lines:
+                if line.axes is axis:
+                    axis.draw_artist(line)
+            self.canvas.blit(axis.bbox)
+        self.canvas.flush_events()
+
+    def close(self):
+        """ go back to drawing the lines normally. """
+        self.canvas.mpl_disconnect(self.cid)
+        for line in self.lines:
+            line.set_animated(False)
+        self.canvas.draw()
+
+def _outside_view(axis, bounds):
+    """ True if (xmin, xmax, ymin, ymax) bounds exceed the view limits """
+    x0, x1 = sorted(axis.get_xlim())
+    y0, y1 = sorted(axis.get_ylim())
+    xmin, xmax, ymin, ymax = bounds
+    return xmin < x0 or xmax > x1 or ymin < y0 or ymax > y1
+
+def _extend(bounds, xs, ys):
+    """ grow (xmin, xmax, ymin, ymax) bounds to include some points """
+    xmin, xmax, ymin, ymax = min(xs), max(xs), min(ys), max(ys)
+    if bounds is None:
+        return (xmin, xmax, ymin, ymax)
+    return (min(bounds[0], xmin), max(bounds[1], xmax),
+            min(bounds[2], ymin), max(bounds[3], ymax))
+
+def _append(buffers, batch):
+    """ add a batch of yielded values to the x_n and y_n buffers """
+    if len(batch) == 1:
+        for pt, buf in zip(batch[0], buffers):
+            buf.append(pt)
+    else:
+        for column, buf in zip(zip(*batch), buffers):
+            buf.extend(column)
+
+_finished = object() # marks the end of the producer's output
+
+def _batches(gen, threaded=False, timeout=0.1):
+    """
+    Read from a generator, yielding lists of the values it yields.
+
+    Without threading, these are lists of one value each. With
+    threading, the generator runs in a separate (producer) thread,
+    and each list holds whatever it has yielded since the last one -
+    possibly nothing, if ``timeout`` seconds go by without a value.
+    Exceptions raised by the generator are re-raised here.
+
+    """
+    if not threaded:
+        for points in gen:
+            yield [points]
+        return
+
+    import threading
+    import Queue
+    queue = Queue.Queue()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for points in gen:
+                queue.put(points)
+                if stop.is_set():
+                    break
+        except Exception as err:
+            queue.put(err)
+        queue.put(_finished)
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+
+    try:
+        done = False
+        while not done:
+            try:
+                batch = [queue.get(timeout=timeout)]
+                while True:
+                    batch.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+            if batch and batch[-1] is _finished:
+                batch.pop()
+                done = True
+            for item in batch:
+                if isinstance(item, Exception):
+                    raise item
+            yield batch
+    finally:
+        stop.set()
+
+def plotgen(gen, ax=None, maxlen=None, fps=None, threaded=False,
+            decimate=None, **kwargs):
     """
     Take X,Y data from a generator, and plot it at the same time.
 
     :param gen: a generator object yielding X,Y pairs.
     :param ax: an axes object (optional).
     :param maxlen: maximum number of points to retain (optional).
+    :param fps: maximum redraws per second (optional).
+    :param threaded: run the generator in its own thread (optional).
+    :param decimate: plot a min/max envelope of the data (optional).
     :returns: an array of the measured X and Y values.
 
     Any extra keyword arguments are passed to the plot function.
@@ -36,12 +454,40 @@ def plotgen(gen, ax=None, maxlen=None, **kwargs):
     plotted lines each grow to this number of points, the oldest data
     points will start being trimmed off the line's trailing end.
 
+    ``fps``, when provided, decouples reading from drawing. Points
+    are taken from the generator as fast as it yields them, and the
+    plot is redrawn at most ``fps`` times per second. Only the lines
+    are redrawn (blitted), and the axes are only rescaled when data
+    falls outside the current view. Without it, the whole figure is
+    redrawn and rescaled after every point, which is fine for slow
+    scans but limits fast generators to the redraw rate.
+
+    ``threaded``, when True, runs the generator in a separate thread
+    which feeds points to the plot through a queue. Then the time
+    spent drawing never delays the next measurement, so the timing
+    of :func:`wanglib.util.scanner` or :func:`wanglib.util.monitor`
+    is the same as without a plot. Points that arrive during a redraw
+    are all added at the next one. The generator must not use
+    pylab itself.
+
+    ``decimate``, when provided, limits the number of points drawn.
+    The visible x range is divided into columns - ``decimate`` of
+    them, or one per pixel if ``decimate=True`` - and only the lowest
+    and highest point of each column is plotted. This looks the same
+    as plotting everything, but stays fast for millions of points.
+    Zooming in recomputes the envelope from the full data, which are
+    kept (and returned). :func:`wanglib.pylab_extensions.misc.gll`
+    and :func:`~wanglib.pylab_extensions.misc.sll` also use the full
+    data of decimated lines.
+
     """
     import matplotlib
-    if 'inline' in matplotlib.get_backend():
+    inline = 'inline' in matplotlib.get_backend()
+    if inline:
         from IPython import display
 
     if ax is None:
+        from pylab import gca
         ax = gca()
 
     # obtain first value
@@ -55,26 +501,44 @@ def plotgen(gen, ax=None, maxlen=None, **kwargs):
 
     assert len(ax) == len(points) / 2
 
-    # maintain x_n and y_n lists (we'll append to these as we go)
-    deques = [deque([point], maxlen) for point in points]
+    # maintain x_n and y_n buffers (we'll append to these as we go)
+    buffers = [_ringbuffer(maxlen) for point in points]
+    for pt, buf in zip(points, buffers):
+        buf.append(pt)
 
     # make some (initially length-1) lines.
     lines = []
-    for axis, x, y in zip(ax, deques[::2], deques[1::2]):
-        line, = axis.plot(x, y, **kwargs)
+    for axis, x, y in zip(ax, buffers[::2], buffers[1::2]):
+        line, = axis.plot(x.view, y.view, **kwargs)
         lines.append(line)
-    assert len(lines) == len(deques) / 2
+    assert len(lines) == len(buffers) / 2
+
+    # these keep the lines up to date with the buffers
+    feeds = []
+    for axis, line, x, y in zip(ax, lines, buffers[::2], buffers[1::2]):
+        columns = decimate
+        if decimate is True:
+            columns = int(axis.bbox.width)
+        feeds.append(_decimator(line, x, y, columns))
+
+    batches = _batches(gen, threaded,
+                       timeout=0.1 if fps is None else 1. / fps)
+
+    if fps is not None:
+        _plotgen_throttled(batches, ax, lines, buffers, feeds, fps)
+        return [buf.view for buf in buffers]
 
-    for points in gen: # for new x_n,y_n tuple generated
+    for batch in batches: # for new x_n,y_n tuples generated
+        if not batch:
+            ax[0].figure.canvas.flush_events()
+            continue
 
-        # append to the deques
-        for pt,deq in zip(points, deques):
-            deq.append(pt)
+        # append to the buffers
+        _append(buffers, batch)
 
-        # update the lines
-        for line,xdata,ydata in zip(lines, deques[::2], deques[1::2]):
-            line.set_data(xdata, ydata)  # update plot with new data
-            line._invalid = True         # this clears the cache?
+        # update the lines (over all the data, since we rescale)
+        for feed in feeds:
+            feed.update(feed.extent())
 
         # rescale the axes
         for axis in ax:
@@ -82,14 +546,64 @@ def plotgen(gen, ax=None, maxlen=None, **kwargs):
             axis.autoscale_view()  # autoscale the bounds to include it all
 
         # redraw the figure
-        if 'inline' in matplotlib.get_backend():
+        if inline:
             display.clear_output(wait=True)
             display.display(ax[0].figure)
         else:
             ax[0].figure.canvas.draw()  # force a redraw
 
-    result = [line.get_data() for line in lines]
-    return list(itertools.chain(*result))
+    return [buf.view for buf in buffers]
+
+def _plotgen_throttled(batches, ax, lines, buffers, feeds, fps):
+    """ the fps mode of plotgen: read fast, draw at a capped rate. """
+    import matplotlib
+    inline = 'inline' in matplotlib.get_backend()
+    if inline:
+        from IPython import display
+    else:
+        blitter = _blitter(lines)
+
+    # extent of the data in each axes, grown as points arrive
+    bounds = dict((axis, None) for axis in ax)
+    for axis, x, y in zip(ax, buffers[::2], buffers[1::2]):
+        bounds[axis] = _extend(bounds[axis], x.view, y.view)
+
+    def refresh():
+        rescale = [axis for axis in bounds
+                   if _outside_view(axis, bounds[axis])]
+        for axis, feed in zip(ax, feeds):
+            if axis in rescale:
+                # envelope of everything, so relim sees it all
+                feed.update(bounds[axis][:2])
+            else:
+                feed.update()
+        for axis in rescale:
+            axis.relim()
+            axis.autoscale_view()
+        if inline:
+            display.clear_output(wait=True)
+            display.display(ax[0].figure)
+        elif rescale:
+            ax[0].figure.canvas.draw() # recaptures the backgrounds
+        else:
+            blitter.redraw()
+
+    interval = 1. / fps
+    last = time()
+    try:
+        for batch in batches:
+            if batch:
+                _append(buffers, batch)
+                columns = zip(*batch)
+                for axis, x, y in zip(ax, columns[::2], columns[1::2]):
+                    bounds[axis] = _extend(bounds[axis], x, y)
+            if time() - last >= interval:
+                refresh()
+                last = time()
+        refresh()
+    finally:
+        if not inline:
+            blitter.close()
 
 if __name__ == '__main__':
 
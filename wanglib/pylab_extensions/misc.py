@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 
-from pylab import gca, sca, draw
+import os
 import numpy
-from time import sleep
+from time import sleep, ctime
 from wanglib.util import save
 
 def cll(index = -1):
@@ -12,6 +12,7 @@ def cll(index = -1):
     To remove a different line, specify the index.
 
     """
+    from pylab import gca, draw
     ax = gca()
     ax.lines.pop(index) # delete the line
     ax.relim()          # recalc limits
@@ -23,7 +24,7 @@ def bll(index = -1, lag = 0.3):
     blink the last line, identifying it
 
     """
-
+    from pylab import gca, draw
     line = gca().lines[index]
     lw, ms = line.get_lw(), line.get_ms() # preserve original state
     line.set_lw(lw * 2) # double the width of lines
@@ -34,6 +35,16 @@ def bll(index = -1, lag = 0.3):
     line.set_ms(ms) # and marker sizes
     draw()
 
+def _get_data(line):
+    """
+    x,y data of a line. for lines decimated by plotgen,
+    this is the full data rather than what is drawn.
+
+    """
+    if hasattr(line, 'decimator'):
+        return line.decimator.data
+    return line.get_data()
+
 def gll(index = -1, blink = True):
     """
     Get last line.
@@ -44,8 +55,9 @@ def gll(index = -1, blink = True):
     To get a different line, specify the index.
 
     """
+    from pylab import gca
     line = gca().lines[index]
-    x,y = line.get_data()
+    x,y = _get_data(line)
     if blink:
         bll(index) # blink the line which one we are getting
     return numpy.array(x), numpy.array(y)
@@ -60,8 +72,9 @@ def sll(fname, index = -1, blink = True):
     To save a different line, specify the index.
 
     """
+    from pylab import gca
     line = gca().lines[index]
-    x,y = line.get_data()
+    x,y = _get_data(line)
 
     if hasattr(fname, 'save'):
         # for sequential savers, use save method
@@ -73,6 +86,93 @@ def sll(fname, index = -1, blink = True):
     if blink:
         bll(index) # blink the line to indicate a successful save
 
+# bulk versions of gll and sll: all lines at once, without blinking
+
+def _all_lines(where=None):
+    """ (axes number, line) for every line in an axes or figure """
+    from matplotlib.figure import Figure
+    if where is None:
+        from pylab import gca
+        where = gca()
+    axes = where.axes if isinstance(where, Figure) else [where]
+    return [(i, line) for i, ax in enumerate(axes) for line in ax.lines]
+
+def gal(where=None):
+    """
+    Get all lines.
+
+    Retrieves x,y data of every line in an axes or figure (default:
+    the current axes), as a list of tuples of two numpy arrays.
+    Nothing blinks or gets redrawn.
+
+    """
+    return [tuple(numpy.array(d) for d in _get_data(line))
+            for i, line in _all_lines(where)]
+
+_reserved = ('x', 'y', 'lengths', 'label', 'axes',
+             'xlabel', 'ylabel', 'created')
+
+def sal(fname, where=None, **metadata):
+    """
+    Save all lines.
+
+    Saves x,y data of every line in an axes or figure (default: the
+    current axes) to a single compressed .npz file, without blinking.
+
+    :param fname: file name. Raises ValueError if it exists.
+    :param where: an axes or figure.
+
+    Any keyword arguments are saved too, as metadata.
+
+    The file is columnar: the data of all lines are concatenated
+    into two arrays ``x`` and ``y``, and ``lengths`` gives the number
+    of points in each line. Each line's ``label``, the ``axes`` it was
+    on (counting from 0), and that axes' ``xlabel`` and ``ylabel`` are
+    saved alongside, along with the time (``created``).
+    Use :func:`load_lines` to split them up again.
+
+    """
+    if not fname.endswith('.npz'):
+        fname = fname + '.npz'
+    if os.path.exists(fname):
+        raise ValueError('file exists. choose a different name')
+    for key in metadata:
+        if key in _reserved:
+            raise ValueError("'%s' is reserved" % key)
+    lines = _all_lines(where)
+    data = [_get_data(line) for i, line in lines]
+    numpy.savez_compressed(fname,
+        x=numpy.concatenate([x for x, y in data] or [[]]).astype(float),
+        y=numpy.concatenate([y for x, y in data] or [[]]).astype(float),
+        lengths=numpy.array([len(x) for x, y in data], dtype=int),
+        label=numpy.array([line.get_label() for i, line in lines]),
+        axes=numpy.array([i for i, line in lines], dtype=int),
+        xlabel=numpy.array([line.axes.get_xlabel() for i, line in lines]),
+        ylabel=numpy.array([line.axes.get_ylabel() for i, line in lines]),
+        created=ctime(), **metadata)
+
+def load_lines(fname):
+    """
+    Load lines saved by :func:`sal`.
+
+    :returns: a list of (x, y) tuples, one per line, and a dict
+              of everything else in the file (labels, metadata).
+
+    >>> lines, info = load_lines('spectra.npz')
+    >>> for (x, y), label in zip(lines, info['label']):
+    ...     plot(x, y, label=label)
+
+    """
+    f = numpy.load(fname)
+    lengths = f['lengths']
+    splits = numpy.cumsum(lengths)[:-1]
+    xs = numpy.split(f['x'], splits)
+    ys = numpy.split(f['y'], splits)
+    info = dict((key, f[key]) for key in f.files
+                if key not in ('x', 'y', 'lengths'))
+    f.close()
+    return zip(xs, ys)[:len(lengths)], info
+
 # some line-editing functions
 
 def relim(line):
@@ -101,6 +201,100 @@ def apply_reference(line, ref):
     line.set_ydata(absorption)
     relim(line)
 
+# batch versions of the above. These take a list of lines, or an
+# axes (meaning all of its lines), or None (all lines in the current
+# axes), and redraw only once at the end.
+
+def _get_lines(lines):
+    """ list of lines from a list, an axes, or None (current axes) """
+    if lines is None:
+        from pylab import gca
+        lines = gca()
+    if hasattr(lines, 'lines'):
+        lines = lines.lines
+    return list(lines)
+
+def _per_line(arg):
+    """ True if arg is a sequence of arrays, one per line """
+    return numpy.ndim(arg) > 0 and len(arg) > 0 and numpy.ndim(arg[0]) > 0
+
+def relim_all(lines):
+    """ redraw the figures of many lines, once each. """
+    axes, figures = [], []
+    for line in lines:
+        if line.axes not in axes:
+            axes.append(line.axes)
+        if line.figure not in figures:
+            figures.append(line.figure)
+    for ax in axes:
+        ax.relim()
+        ax.autoscale_view()
+    for fig in figures:
+        fig.canvas.draw()
+
+def _transform(lines, func, arg, per_line):
+    """
+    Set the y data of each line to ``func(y, arg)``.
+
+    If all lines are the same length, their data are stacked and
+    transformed in a single operation (``arg`` broadcasting against
+    the stack). If ``per_line``, ``arg`` has one entry per line.
+
+    """
+    lines = _get_lines(lines)
+    if not lines:
+        return
+    ys = [line.get_ydata() for line in lines]
+    if len(set(len(y) for y in ys)) == 1:
+        if per_line:
+            arg = numpy.asarray(arg)
+        new = func(numpy.array(ys, dtype=float), arg)
+    else:
+        args = arg if per_line else [arg] * len(lines)
+        new = [func(numpy.asarray(y, dtype=float), a)
+               for y, a in zip(ys, args)]
+    for line, y in zip(lines, new):
+        line.set_ydata(y)
+    relim_all(lines)
+
+def apply_masks(mask, lines=None):
+    """
+    mask many lines at once.
+
+    :param mask: boolean array of points to keep: either one mask
+                 for all lines, or a stack of masks, one per line.
+    :param lines: list of lines, or an axes. Default: current axes.
+
+    """
+    _transform(lines, lambda y, m: numpy.where(m, y, numpy.nan),
+               mask, _per_line(mask))
+
+def apply_offsets(offset, lines=None):
+    """
+    move many lines up or down at once.
+
+    :param offset: a single offset, or one per line
+                   (e.g. to stack spectra in a waterfall).
+    :param lines: list of lines, or an axes. Default: current axes.
+
+    """
+    per_line = numpy.ndim(offset) > 0
+    if per_line:
+        # a column, so each offset broadcasts along its own line
+        offset = numpy.reshape(offset, (-1, 1))
+    _transform(lines, lambda y, o: y + o, offset, per_line)
+
+def apply_references(ref, lines=None):
+    """
+    apply reference data to many lines at once.
+
+    :param ref: reference data: either one spectrum for all lines,
+                or a stack of spectra, one per line.
+    :param lines: list of lines, or an axes. Default: current axes.
+
+    """
+    _transform(lines, lambda y, r: numpy.log(r / y), ref, _per_line(ref))
+
 # dual-tick functions
 
 def dualtick(func):
@@ -142,6 +336,7 @@ def dualtick(func):
 
     """
     def decorator(ax=None):
+        from pylab import gca, sca, draw
         ax1 = ax if ax else gca()
         ax2 = ax1.twiny()
         ax2.set_ylim(y for y in ax1.get_ylim())
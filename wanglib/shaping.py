@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+"""
+Closed-loop optimization of pulse shapes.
+
+These routines search for the spectral phase that maximizes some
+measured signal - for example, the second harmonic of a shaped pulse,
+detected with a lock-in - by varying a few coefficients of a phase
+basis rather than every pixel of the pulse shaper.
+
+An optimizer needs two things:
+
+    :objective:  a function taking a stack of phase profiles, shape
+                 (N, pixels), and returning the N measured signals.
+    :basis:      a stack of phase profiles to combine, shape
+                 (coefficients, pixels). See :func:`taylor_basis`
+                 and :func:`legendre_basis`.
+
+Candidates are always evaluated in batches. With a real pulse shaper,
+use :class:`shaper_objective`, which renders each batch of masks in
+one go, preloads them onto the display server, and then steps through
+them while measuring. For offline testing, :class:`simulated_shg`
+is an objective that computes the signal instead.
+
+>>> from wanglib.grating import pulseshaper
+>>> ps = pulseshaper()
+>>> objective = shaper_objective(ps, lockin.get_x, lag=0.3)
+>>> opt = coordinate_descent(objective, taylor_basis(ps.dim[0]))
+>>> best = opt.run(10)
+>>> ps.phase = opt.phases(best)[0]
+
+Every evaluation is recorded in the ``history`` attribute of the
+optimizer, and the best signal found after each iteration in
+``progress``.
+
+"""
+
+import numpy
+from time import sleep
+
+def taylor_basis(pixels, orders=(2, 3), center=None):
+    """
+    Polynomial phase profiles (quadratic, cubic, ...).
+
+    :param pixels: number of pixels across the shaper.
+    :param orders: which powers to include. Orders 0 and 1 (a
+                   constant phase, and a delay) don't change the
+                   pulse shape, so are left out by default.
+    :param center: pixel about which to expand. Default: the middle.
+    :returns: array of shape (len(orders), pixels).
+
+    The pixel axis is normalized to [-1, 1] about the center, so a
+    coefficient is the phase (in 2pi units) at the edge of the shaper.
+
+    """
+    x = numpy.arange(pixels, dtype=float)
+    if center is None:
+        center = (pixels - 1) / 2.
+    x = (x - center) / max(center, pixels - 1 - center)
+    return numpy.array([x ** k for k in orders])
+
+def legendre_basis(pixels, orders=(2, 3, 4)):
+    """
+    Legendre polynomial phase profiles.
+
+    The 1-D analogue of a Zernike basis: the same span as
+    :func:`taylor_basis`, but orthogonal over the shaper, so the
+    coefficients interact less during a search.
+
+    :param pixels: number of pixels across the shaper.
+    :param orders: which polynomial orders to include.
+    :returns: array of shape (len(orders), pixels).
+
+    """
+    from numpy.polynomial import legendre
+    x = numpy.linspace(-1, 1, pixels)
+    return numpy.array([legendre.legval(x, [0] * k + [1]) for k in orders])
+
+class shaper_objective(object):
+    """
+    Measure a signal for each of a batch of phase profiles,
+    using a pulse shaper.
+
+    :param shaper: a :class:`wanglib.grating.pulseshaper`.
+    :param measure: function returning the signal (e.g. ``li.get_x``).
+    :param lag: seconds to wait after showing each mask.
+
+    Each batch is rendered with :meth:`pulseshaper.render` and
+    uploaded with :meth:`pulseshaper.preload` before any measurement
+    starts, so stepping from one candidate to the next only sends the
+    mask ID. Masks the display server has seen before (like the
+    current best, which gets re-measured often) are not re-uploaded.
+
+    Only the phase profiles are combined from the basis; each
+    candidate's mask is rendered from its total phase. Masks can't
+    be built up from rendered basis masks, because the grating and
+    the gray-level quantization are not linear in the phase.
+
+    """
+    def __init__(self, shaper, measure, lag=0.1):
+        self.shaper = shaper
+        self.measure = measure
+        self.lag = lag
+
+    def __call__(self, phases):
+        masks = self.shaper.render(phases)
+        self.shaper.preload(masks)
+        values = []
+        for i in range(len(masks)):
+            self.shaper.showframe(i)
+            sleep(self.lag)
+            values.append(self.measure())
+        return numpy.array(values, dtype=float)
+
+class simulated_shg(object):
+    """
+    Simulated second-harmonic detector behind a pulse shaper.
+
+    The shaper pixels sample a Gaussian spectrum which carries an
+    unknown spectral phase. The signal is the integrated square of
+    the pulse intensity, normalized so that a transform-limited
+    pulse gives 1. The best phase to apply is the negative of the
+    unknown one.
+
+    :param pixels: number of pixels across the shaper.
+    :param dispersion: Taylor coefficients of the unknown phase,
+                       orders 0, 1, 2, ... (2pi units at the edge
+                       of the shaper, as in :func:`taylor_basis`).
+    :param width: spectral FWHM, as a fraction of the shaper width.
+    :param noise: relative RMS noise added to each measurement.
+
+    >>> sim = simulated_shg(640, dispersion=(0, 0, 3, -1))
+    >>> opt = coordinate_descent(sim, taylor_basis(640))
+
+    """
+    def __init__(self, pixels, dispersion=(0, 0, 2., -1.),
+                 width=0.4, noise=0.01, seed=None):
+        self.pixels = pixels
+        self.noise = noise
+        self.random = numpy.random.RandomState(seed)
+        x = numpy.linspace(-1, 1, pixels)
+        # x spans 2 units, so the FWHM is 2 * width in those units
+        sigma = 2 * width / numpy.sqrt(8 * numpy.log(2))
+        self.spectrum = numpy.exp(-x ** 2 / (2 * sigma ** 2))
+        orders = range(len(dispersion))
+        self.phase = numpy.dot(dispersion, taylor_basis(pixels, orders))
+        self._norm = 1.
+        self._norm = self.signal(-self.phase)[0]
+
+    def signal(self, phases, amps=1.):
+        """ the noiseless signal for a stack of phase profiles """
+        phases = numpy.atleast_2d(phases)
+        field = self.spectrum * amps * \
+                numpy.exp(2j * numpy.pi * (phases + self.phase))
+        # zero-pad so the pulse isn't wrapped around in time
+        pulse = numpy.fft.fft(field, n=4 * self.pixels, axis=-1)
+        intensity = abs(pulse) ** 2
+        return (intensity ** 2).sum(axis=-1) / self._norm
+
+    def __call__(self, phases):
+        signal = self.signal(phases)
+        return signal * (1 + self.noise * self.random.randn(len(signal)))
+
+class optimizer(object):
+    """
+    Base class for the search strategies below.
+
+    :param objective: function mapping a stack of phase profiles
+                      to measured signals. Larger is better.
+    :param basis: stack of phase profiles to combine.
+    :param start: initial coefficients. Default: all zero.
+
+    Attributes:
+        coeffs -- current coefficients
+        history -- list of (coefficients, signal) for every evaluation
+        progress -- best signal so far, after each iteration
+
+    Subclasses must define a ``step()`` method, which performs one
+    iteration of the search (evaluating candidates with
+    :meth:`evaluate` and updating ``coeffs``). :meth:`run` calls it
+    once per iteration.
+
+    """
+    def __init__(self, objective, basis, start=None):
+        self.objective = objective
+        self.basis = numpy.atleast_2d(basis)
+        if start is None:
+            start = numpy.zeros(len(self.basis))
+        self.coeffs = numpy.array(start, dtype=float)
+        self.history = []
+        self.progress = []
+
+    def phases(self, coeffs):
+        """ phase profiles for a stack of coefficient vectors """
+        return numpy.dot(numpy.atleast_2d(coeffs), self.basis)
+
+    def evaluate(self, coeffs):
+        """ measure a batch of coefficient vectors, recording them """
+        coeffs = numpy.atleast_2d(coeffs)
+        values = numpy.asarray(self.objective(self.phases(coeffs)),
+                               dtype=float)
+        for c, v in zip(coeffs, values):
+            self.history.append((c.copy(), v))
+        return values
+
+    @property
+    def best(self):
+        """ (coefficients, signal) of the best evaluation so far """
+        return max(self.history, key=lambda entry: entry[1])
+
+    def run(self, iterations):
+        """
+        Run some iterations of the search.
+
+        Returns the best coefficients found so far.
+
+        """
+        for i in range(iterations):
+            self.step()
+            self.progress.append(self.best[1])
+        return self.best[0]
+
+class coordinate_descent(optimizer):
+    """
+    Optimize one basis coefficient at a time.
+
+    Each coefficient is measured at three points (the current
+    value, and ``step`` either side of it) in a single batch, and
+    moved to the peak of the parabola through them. After each
+    iteration (a pass over all coefficients) in which no coefficient
+    moved by more than a step, the step shrinks by ``shrink``.
+
+    """
+    def __init__(self, objective, basis, start=None,
+                 step=0.5, shrink=0.7):
+        super(coordinate_descent, self).__init__(objective, basis, start)
+        self.stepsize = step
+        self.shrink = shrink
+
+    def step(self):
+        s = self.stepsize
+        largest = 0.
+        for k in range(len(self.coeffs)):
+            trial = numpy.tile(self.coeffs, (3, 1))
+            trial[:, k] += (-s, 0, s)
+            lo, mid, hi = self.evaluate(trial)
+            curvature = lo - 2 * mid + hi
+            if curvature < 0:
+                # concave: go to the vertex, but not too far
+                move = numpy.clip(s * (lo - hi) / (2 * curvature),
+                                  -2 * s, 2 * s)
+            else:
+                move = (-s, 0, s)[numpy.argmax((lo, mid, hi))]
+            self.coeffs[k] += move
+            largest = max(largest, abs(move))
+        if largest < s:
+            self.stepsize *= self.shrink
+
+class evolution_strategy(optimizer):
+    """
+    Optimize all coefficients at once with a simple evolution
+    strategy.
+
+    Each generation, ``popsize`` candidates are drawn from a
+    Gaussian of width ``sigma`` about the current coefficients and
+    measured as one batch. The coefficients move to a weighted mean
+    of the best half. ``sigma`` grows when many candidates beat the
+    previous generation's best, and shrinks otherwise (a "1/5
+    success" rule rather than full CMA-ES covariance adaptation).
+
+    """
+    def __init__(self, objective, basis, start=None,
+                 popsize=12, sigma=0.5, seed=None):
+        super(evolution_strategy, self).__init__(objective, basis, start)
+        self.popsize = popsize
+        self.sigma = sigma
+        self.random = numpy.random.RandomState(seed)
+        mu = popsize // 2
+        weights = numpy.log(mu + 0.5) - numpy.log(numpy.arange(1, mu + 1))
+        self.weights = weights / weights.sum()
+        self._previous = None
+
+    def step(self):
+        shape = (self.popsize, len(self.coeffs))
+        population = self.coeffs + self.sigma * self.random.randn(*shape)
+        values = self.evaluate(population)
+        ranked = numpy.argsort(values)[::-1][:len(self.weights)]
+        self.coeffs = numpy.dot(self.weights, population[ranked])
+        if self._previous is not None:
+            success = numpy.mean(values > self._previous)
+            self.sigma *= numpy.exp(success - 0.2)
+        self._previous = values[ranked[0]]
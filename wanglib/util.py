@@ -290,6 +290,13 @@ def monitor(function, lag = 0.3, absolute = False):
         yield time() - start, function()
         sleep(lag)
 
+def _wait(lag):
+    """ sleep for lag seconds, or call lag if it's a function """
+    if hasattr(lag, '__call__'):
+        lag()
+    else:
+        sleep(lag)
+
 def scanner(xvals, set, get, lag = 0.3):
     """
     Generic scan generator - useful for spectra, delay scans, whatever.
@@ -305,8 +312,10 @@ def scanner(xvals, set, get, lag = 0.3):
                 The return value of this function should be the measurement
                 result.
     :type get: function
-    :param lag: seconds to sleep between setting and measuring
-    :type lag: float
+    :param lag: seconds to sleep between setting and measuring,
+                or a function to call that waits (such as a lock-in's
+                ``wait_settled`` method).
+    :type lag: float or function
     :returns:   a generator object yielding x,y pairs.
 
     Example: while scanning triax wavelength, measure lockin x
@@ -335,13 +344,40 @@ def scanner(xvals, set, get, lag = 0.3):
             set(X)
         else:
             set[0].__setattr__(set[1], X)
-        sleep(lag)
+        _wait(lag)
         if hasattr(get,'__call__'):
             Y = get()
         else:
             Y = get[0].__getattribute__(get[1])
         yield X,Y
 
+def scanner2d(horiz, vert, set_horiz, set_vert, get, lag = 0.3):
+    """
+    Two-dimensional version of :func:`scanner`, for raster scans.
+    Compatible with
+    :meth:`wanglib.pylab_extensions.density.live_density.plotgen`.
+
+    :param horiz: values of the fast (inner) variable.
+    :param vert: values of the slow (outer) variable.
+    :param set_horiz: function that sets the fast variable.
+    :param set_vert: function that sets the slow variable.
+    :param get: function that performs the measurement.
+    :param lag: seconds to sleep between setting and measuring,
+                or a function that waits (as in :func:`scanner`).
+    :returns:   a generator object yielding ``(i, j, value)``, where
+                ``i`` indexes ``vert`` and ``j`` indexes ``horiz``.
+
+    >>> gen = scanner2d(xs, ys, stage_x.set_pos, stage_y.set_pos, li.get_x)
+    >>> data = live_density(xs, ys).plotgen(gen)
+
+    """
+    for i, Y in enumerate(vert):
+        set_vert(Y)
+        for j, X in enumerate(horiz):
+            set_horiz(X)
+            _wait(lag)
+            yield i, j, get()
+
 def averager(func, n, lag=0.1):
     """
     Given a function ``func``, returns an implementation of that